@@ -9,7 +9,7 @@ May 2022
 For details, see  https://doi.org/10.1016/j.trc.2020.102781
 """
 
-import sys, os, platform, time, subprocess, datetime, math
+import sys, os, platform, time, subprocess, datetime, math, hashlib, json, itertools, io
 global defaults
 if sys.version_info < (3, 0):
     sys.stdout.write("Sorry, requires Python 3. You are running Python 2.\n")
@@ -52,11 +52,12 @@ cores = 4
 
 import numpy as np
 import pandas as pd
-import multiprocessing
+import multiprocessing, queue, signal, threading, _thread
 from collections import OrderedDict, defaultdict
 import pgMapMatch.mapmatcher as mm
 import pgMapMatch.tools as  mmt
 from pgMapMatch.config import *
+import cruising_routing as cr
 #from cruising_importLocationData import *
 # from cruising_setup import *
 import csv
@@ -70,9 +71,24 @@ rollSecs = 30       # speed threshold for identification of walking segment at e
 wSpeed = 6          # assumed maximum walking speed (km/h)
 bufferThresh = 0.5  # to be considered cruising, at least this fraction of the last portion of the trip must be within the 400m buffer
 qualityCutoff = 0.9 # To be retained, a trip must have at least this probability of being good
+cruiseExcessDist = 5        # a trip is cruising if its map-matched distance is at least this much (meters) longer than the network distance
+highCruiseExcessDist = 200  # ...and high cruising if it is at least this much longer
 r = '400'           # the buffer radius (meters)
 rd = str(int(r)*2)  # radius of donut
-mapmatch_timeout  = 300        # timeout for each individual postgres query, in seconds. Making it shorter will skip long and stubborn traces
+bufferRadii = []    # additional buffer radii (meters), e.g. [200, 800]. The buffer metrics are also calculated for each of these, in columns suffixed with the radius (e.g. id_first_200), along with cruise and high_cruise
+mapmatch_timeout  = 300        # time limit for map matching each trace, in seconds. Traces that take longer are quarantined and retried at the end with a longer limit
+netwkdistCacheStep = 1000           # positions on the start and end edge are rounded to 1/netwkdistCacheStep of the edge in the network distance cache
+netwkdistCacheMaxRows = 10000000    # maximum size of the network distance cache. The least recently used routes are dropped
+routingBuffers = [1000, 4000, 16000] # envelopes (meters around the start and end edges) tried in turn when routing on a subgraph, before using the whole network
+routingMethod = 'pgr_trsp'          # how runall() calculates network distances: 'pgr_trsp', 'pgr_trsp_bbox' or 'inprocess'. See calcAllNetworkDistances()
+routingMaxCost = 1e5                # the in-process router gives up (and netwkdist is Null) when the cost of the route exceeds this. See cruising_routing.py
+tripCacheMaxRows = 5000000          # maximum number of trips in each per-trip results cache. The least recently used trips are dropped
+downsampleSpacing = None            # if set (meters), lbuff_geom is thinned to about this spacing before map matching. See downsampleTraces()
+downsampleSecs = None               # if set (seconds), lbuff_geom is thinned to about this interval between pings before map matching
+downsampleTurnAngle = 30            # when thinning, pings where the trace turns by more than this (degrees) are kept
+earlyRejection = False              # if True, skip map matching and routing for trips that defineUsableTrips() would discard anyway. See rejectTrips()
+lazyGeometries = False              # if True, the sub-lines of the trace in lazyLines are not stored, but calculated on demand (see lineSql()), and lines_original is only kept where pings were dropped
+narrowTables = False                # if True, the stages in narrowStages write to their own tables, rather than adding columns to the trace table. See createResultsView()
 
 def loadTables(region=None):
     """
@@ -273,6 +289,10 @@ class traceTable():
         self.forceUpdate = forceUpdate
         self.ids = None
         self.nPings = None
+        self.connectionTime = None
+        self.currentFingerprint = None  # fingerprint of the stage that runall() is running. See stageGraph()
+        self.classificationFeatures = None  # see getClassificationFeatures()
+        self.minCostPerMeter = None  # see getMinCostPerMeter()
 
         if schema!=mm.pgInfo['schema']:
             raise Warning('The schema in your pgMapMatch config file is {}. This does not match the schema passed to cruising.py: {}.\nThis may cause problems - please check!'.format(mm.pgInfo['schema'], schema))
@@ -320,10 +340,149 @@ class traceTable():
         self.nPings = OrderedDict((rr[0],rr[1]) for rr in result)
         return self.nPings
 
+    def stageStatus(self, stage):
+        """Returns 'running' if stage was started but did not finish (e.g. the computer crashed), 'done' if it finished, or None
+        The status of each stage is in <table>_stages, and the trips that a running stage has completed are in <table>_progress"""
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s_stages (stage text PRIMARY KEY, status text, updated timestamp, fingerprint text);' % self.table)
+        self.db.execute('ALTER TABLE %s_stages ADD COLUMN IF NOT EXISTS fingerprint text;' % self.table)
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s_progress (stage text, trip_id bigint, PRIMARY KEY (stage, trip_id));' % self.table)
+        result = self.db.execfetch("SELECT status FROM %s_stages WHERE stage='%s';" % (self.table, stage))
+        return None if len(result)==0 else result[0][0]
+
+    def isResuming(self, stage):
+        """True if stage was interrupted, and should carry on with the trips that it hasn't done yet rather than start again"""
+        if self.stageStatus(stage)=='running' and not self.forceUpdate:
+            self.writeLog('Resuming %s, which did not finish last time' % stage)
+            return True
+        return False
+
+    def startStage(self, stage, resume=False, resultsTn=None):
+        """Record that stage is running. Returns the set of trip_ids that it has already completed, if resuming
+        resultsTn: the results table of the stage (see resultsWriter), if any. When resuming, trips that are recorded as completed
+                   but have no row in it (e.g. if the table was lost) are done again"""
+        if resume and resultsTn is not None:
+            if resultsTn in self.db.list_tables():
+                self.db.execute("""DELETE FROM %s_progress p WHERE stage='%s' AND NOT EXISTS (SELECT 1 FROM %s r WHERE r.trip_id=p.trip_id);""" % (
+                                    self.table, stage, resultsTn))
+            else:
+                self.db.execute("DELETE FROM %s_progress WHERE stage='%s';" % (self.table, stage))
+        if not resume:
+            self.db.execute("DELETE FROM %s_progress WHERE stage='%s';" % (self.table, stage))
+            self.db.execute("""INSERT INTO %s_stages (stage, status, updated, fingerprint) VALUES ('%s', 'running', now(), %s)
+                               ON CONFLICT (stage) DO UPDATE SET status='running', updated=now(), fingerprint=EXCLUDED.fingerprint;""" % (
+                               self.table, stage, sqlValue(self.currentFingerprint)))
+        done = set([rr[0] for rr in self.db.execfetch("SELECT trip_id FROM %s_progress WHERE stage='%s';" % (self.table, stage))])
+        if resume:
+            self.writeLog('...%d trips already done' % len(done))
+        return done
+
+    def finishStage(self, stage):
+        """Record that stage is done, and clear its list of completed trips"""
+        self.db.execute("UPDATE %s_stages SET status='done', updated=now() WHERE stage='%s';" % (self.table, stage))
+        self.db.execute("DELETE FROM %s_progress WHERE stage='%s';" % (self.table, stage))
+
+    def statementName(self, stage):
+        """Name of the prepared statement for a per-trip query on this table"""
+        return ('%s_%s' % (self.table, stage)).replace('.','_')
+
+    def logTripTiming(self, stage, nTrips, seconds, nSamples=3):
+        """Log the time per trip, and an estimate of the time saved by each worker reusing one database connection (rather than one per trip)
+        The estimate is the median time to open a new connection and run a trivial query on it, less the time to run it on an existing connection
+        It is only measured once, with nSamples of each, and is approximate, because it does not include the load on the server while the stage is running"""
+        if self.connectionTime is None:
+            newTimes, reuseTimes = [], []
+            for ii in range(nSamples):
+                starttime = time.time()
+                db = mmt.dbConnection(pgLogin=self.pgLogin, verbose=False)
+                db.execfetch('SELECT 1;')
+                newTimes.append(time.time()-starttime)
+                db.connection.close()
+                starttime = time.time()
+                self.db.execfetch('SELECT 1;')
+                reuseTimes.append(time.time()-starttime)
+            self.connectionTime = max(np.median(newTimes)-np.median(reuseTimes), 0)
+        self.writeLog('%s: %d trips in %d seconds (%.1f ms per trip). Reusing database connections saved an estimated %.1f ms per trip' % (
+                        stage, nTrips, seconds, 1000.*seconds/max(nTrips,1), 1000.*self.connectionTime))
+
+    def stageTn(self, stage):
+        """Narrow results table of stage (keyed by trip_id), if narrowTables is True
+        For truncate, this is the results table that truncateAllLines() writes to in any case"""
+        return '%s_%s' % (self.table, 'truncated' if stage=='truncate' else stage)
+
+    def resultsTn(self):
+        """Table or view to read the results of earlier stages from
+        This is the trace table itself, unless narrowTables is True, when it is the view made by createResultsView()"""
+        return self.table+'_results' if narrowTables else self.table
+
+    def createResultsView(self):
+        """(Re)create <table>_results, a view that joins the trace table to the narrow results table of each stage in narrowStages
+        that has been run. If a column is in more than one of them (e.g. from an earlier run without narrowTables), the last one is used"""
+        colSources = OrderedDict((cc, 't') for cc in self.db.list_columns_in_table(self.table))
+        joins = ''
+        for ii, stage in enumerate(narrowStages):
+            if self.stageTn(stage) in self.db.list_tables():
+                colSources.update([(cc, 's%d' % ii) for cc in self.db.list_columns_in_table(self.stageTn(stage)) if cc!='trip_id'])
+                joins += ' LEFT JOIN %s s%d ON t.trip_id=s%d.trip_id' % (self.stageTn(stage), ii, ii)
+        self.db.execute('DROP VIEW IF EXISTS %s;' % self.resultsTn())
+        self.db.execute('CREATE VIEW %s AS SELECT %s FROM %s t%s;' % (
+                            self.resultsTn(), ', '.join(['%s.%s' % (src, cc) for cc, src in colSources.items()]), self.table, joins))
+
+    def hasStageResults(self, stage, column):
+        """True if stage has already written its results, i.e. its narrow table exists (if narrowTables is True), or column is in the trace table
+        Results in the trace table (e.g. from an earlier run without narrowTables) are also in the results view, so are not recalculated"""
+        if narrowTables and self.stageTn(stage) in self.db.list_tables():
+            return True
+        return column in self.db.list_columns_in_table(self.table)
+
+    def dropStageResults(self, stage, cols):
+        """Drop the results of stage, i.e. its narrow table (if narrowTables is True), or its columns (cols) in the trace table"""
+        if narrowTables:
+            self.db.execute('DROP VIEW IF EXISTS %s;' % self.resultsTn())
+            self.db.execute('DROP TABLE IF EXISTS %s;' % self.stageTn(stage))
+            self.createResultsView()
+        else:
+            dropTxt = ', '.join(['DROP COLUMN IF EXISTS '+cc[0] for cc in cols])
+            self.db.execute('ALTER TABLE %s %s;' % (self.table, dropTxt))
+
+    def writeStageResults(self, stage, cols, rowSql, parallel=False, batchsize=5000):
+        """Calculate the columns of stage for every trip, and write them once
+        cols: list of (column name, postgres type) tuples
+        rowSql: a SELECT that returns one row of cols (in order), which can refer to the columns of the trip (and of earlier stages)
+        parallel: if True (and nCores is not None), the trips are split into batches of batchsize consecutive trip_ids, which are written in parallel
+        If narrowTables is True, the results are written to the narrow table of stage (see stageTn()), and the results view is updated
+        Otherwise, the columns are added to the trace table and set in a single UPDATE per batch"""
+        colNames = ', '.join([cc[0] for cc in cols])
+        if narrowTables:
+            self.dropStageResults(stage, cols)
+            self.db.execute('CREATE TABLE %s (trip_id bigint, %s);' % (self.stageTn(stage), ', '.join(['%s %s' % cc for cc in cols])))
+            cmd = '''INSERT INTO %s (trip_id, %s) SELECT t.trip_id, %s FROM %s t, LATERAL (%s) AS s WHERE ''' % (
+                        self.stageTn(stage), colNames, ', '.join(['s.'+cc[0] for cc in cols]), self.resultsTn(), rowSql)
+            idCol = 't.trip_id'
+        else:
+            self.db.addColumns(cols, self.table, dropOld=True)
+            cmd = 'UPDATE %s SET (%s) = (%s) WHERE ' % (self.table, colNames, rowSql)
+            idCol = 'trip_id'
+
+        if parallel and self.nCores is not None:
+            ids = self.getIds()
+            batches = [ids[ii:ii+batchsize] for ii in range(0, len(ids), batchsize)]
+            args = [(cmd+'%s BETWEEN %d AND %d;' % (idCol, batch[0], batch[-1]), self.pgLogin) for batch in batches]
+            starttime = time.time()
+            results = apply_multiprocessing(executeSql_wrapper, args, self.nCores, maxtasksperchild=None, pgLogin=self.pgLogin)
+            if any([rr==-1 for rr in results.values()]):
+                raise Exception('Could not write the results of %s for %d batches of trips' % (stage, len([rr for rr in results.values() if rr==-1])))
+            self.logTripTiming(stage, len(ids), time.time()-starttime)
+        else:
+            self.db.execute(cmd+'True;')
+
+        if narrowTables:
+            self.db.execute('ALTER TABLE %s ADD PRIMARY KEY (trip_id);' % self.stageTn(stage))
+            self.createResultsView()
+
     def dropErrantPings(self):
         if 'lines_original' in self.db.list_columns_in_table(self.table):
             if self.forceUpdate:
-                self.db.execute('UPDATE %s SET lines_geom=lines_original' % (self.table))
+                self.db.execute('UPDATE %s SET lines_geom=COALESCE(lines_original, lines_geom)' % (self.table))
                 self.db.execute('ALTER TABLE %s DROP COLUMN lines_original' % (self.table))
                 self.db.execute('ALTER TABLE %s DROP COLUMN IF EXISTS lines_tmp' % (self.table))
             else:
@@ -333,6 +492,7 @@ class traceTable():
         self.db.execute("SELECT AddGeometryColumn('%s','lines_tmp',%s,'LineStringM',3);" % (self.table, self.srs))
 
         # Drop first point of lines where the 'true' starting point exists. This is because GPS error is highest with the first point
+        sizeBefore = self.tableSize()
         self.db.execute('UPDATE %s SET lines_original = lines_geom' % self.table)
         if 'start_good' in self.db.list_columns_in_table(self.table): # only for SL traces
             self.db.execute('''UPDATE %s SET lines_tmp =
@@ -347,42 +507,118 @@ class traceTable():
             tc = mm.traceCleaner(self.table,'trip_id','lines_original', 'lines_geom', logFn=None)
             tc.fetchAndDrop()
 
-    def createLotPolygons(self):
+        # lines_original is only needed to restore the traces where pings were dropped (see above)
+        if lazyGeometries:
+            self.db.execute('UPDATE %s SET lines_original = Null WHERE ST_AsEWKB(lines_original)=ST_AsEWKB(lines_geom);' % self.table)
+        self.writeLog('...trace table size %.1f MB before dropping errant pings, %.1f MB after' % (sizeBefore, self.tableSize()))
+
+    def createLotPolygons(self, tileSize=2000):
         """Create temporary feature for off-street parking lots and service roads,
-        so that we can exclude them from the end of the trip"""
+        so that we can exclude them from the end of the trip
+        The polygons are built separately (and in parallel) for each tile of tileSize meters across the extent of the traces,
+        and split into small pieces with ST_Subdivide(), so that the in-lot test in truncateLine() can use the spatial index
+        They are in <table>_lotpolygons, because they only cover the extent of this trace table"""
         self.writeLog('Creating lot polygons')
-        if 'lotpolygons' in self.db.list_tables():
+        lotTn = self.table+'_lotpolygons'
+        if lotTn in self.db.list_tables():
             if self.forceUpdate:
-                self.db.execute('DROP TABLE IF EXISTS lotpolygons')
+                self.db.execute('DROP TABLE IF EXISTS %s' % lotTn)
             else:
-                self.writeLog('lotpolygons table already exists. Skipping')
+                self.writeLog('%s table already exists. Skipping' % lotTn)
                 return
 
-        if self.offstreetName in self.db.list_tables():
-            offst_sql = 'SELECT ST_Union(ST_Buffer(geom,10)) As uniongeom FROM {} UNION'.format(self.offstreetName)
-        else:
-            offst_sql = ''
+        offstreetTn = self.offstreetName if self.offstreetName in self.db.list_tables() else None
+        if offstreetTn is None:
             self.writeLog('Warning: (optional) off-street parking table {} not found'.format(self.offstreetName))
-        streetsClip = '''SELECT * FROM %(sts)s
-							WHERE ST_Within(geom_way, (SELECT ST_SetSRID(ST_Extent(lines_geom), %(srs)s) as table_extent FROM sampletraces))''' % {'sts':self.streets, 'srs':self.srs}
-
+        self.db.execute('CREATE TABLE %s (id serial PRIMARY KEY, lotgeom geometry(Polygon, %s));' % (lotTn, self.srs))
 
-        cmd = '''CREATE TABLE lotpolygons AS
-                 (SELECT ST_Difference(lotgeom_big, streetbuffer) AS lotgeom FROM
-                    (SELECT ST_Union(uniongeom) AS lotgeom_big FROM
-                        (%(offst_sql)s
-                         SELECT ST_Buffer(ST_Collect(geom_way), 10) AS uniongeom FROM (%(sts)s) AS streets WHERE clazz=51) t1) t2,
-                    (SELECT ST_Buffer(ST_Collect(geom_way), 5) AS streetbuffer FROM (%(sts)s) AS streets WHERE clazz!=51) t3);
-                    ''' % {'offst_sql':offst_sql, 'sts':streetsClip}
+        xmin, ymin, xmax, ymax = self.db.execfetch('''SELECT ST_XMin(ext), ST_YMin(ext), ST_XMax(ext), ST_YMax(ext)
+                                                      FROM (SELECT ST_Extent(lines_geom) AS ext FROM %s) AS t;''' % self.table)[0]
+        if xmin is None:  # no traces, so the extent is Null
+            tiles = []
+        else:
+            xmax, ymax = max(xmax, xmin+1), max(ymax, ymin+1)  # so that an extent with no width or height (e.g. a single trace along a street) still has a tile
+            tiles = [(x0, y0, min(x0+tileSize, xmax), min(y0+tileSize, ymax)) for x0 in np.arange(xmin, xmax, tileSize).tolist()
+                                                                              for y0 in np.arange(ymin, ymax, tileSize).tolist()]
+        args = [(tile, lotTn, self.streets, offstreetTn, self.srs, self.pgLogin) for tile in tiles]
+        if self.nCores is None:
+            for aa in args:
+                lotPolygons_wrapper(*aa)
+        else:
+            results = apply_multiprocessing(lotPolygons_wrapper, args, self.nCores, maxtasksperchild=None, pgLogin=self.pgLogin)
+            if any([rr==-1 for rr in results.values()]):
+                raise Exception('Could not create lot polygons for %d tiles' % len([rr for rr in results.values() if rr==-1]))
+        self.db.create_indices(lotTn, geom='lotgeom')
+        self.db.execute('ANALYZE %s;' % lotTn)
+        self.writeLog('...%d lot polygons in %d tiles' % (self.db.execfetch('SELECT count(*) FROM %s;' % lotTn)[0][0], len(tiles)))
+
+    def createTraceTails(self):
+        """Pre-truncation: store the tail of each trace in <table>_tails, so that truncateLine() only has to fetch and process those points
+        Only the points near the end point affect the metrics. The tail starts with the last point outside a safe radius
+        (twice the largest buffer radius, or maxDistThres if that is larger), less enough earlier points for the rolling speed window
+        The metrics for the trace as a whole (number of pings and ping times) are calculated here, for the whole trace
+        Traces are left out (and so are processed in full) if an earlier part of the trace comes within the safe radius,
+        if the trace never enters the buffer (so that the buffer metrics are for the whole trace), or if the ping times are not in order
+        See also tailRows()"""
+        tailsTn = self.table+'_tails'
+        if tailsTn in self.db.list_tables():
+            if self.forceUpdate:
+                self.db.execute('DROP TABLE %s;' % tailsTn)
+            else:
+                self.writeLog('Traces already pre-truncated. Skipping')
+                return
+        self.writeLog('Pre-truncating traces')
+        nearRadius = 2*max([int(r)]+extraRadii())
+        cmd = '''CREATE TABLE %(tails)s AS
+                 WITH pts AS (
+                    SELECT trip_id, (dp).path[1] AS ptid, (dp).geom AS geom, ST_M((dp).geom) AS pingtime, ST_Distance((dp).geom, end_geom) AS dist,
+                           ST_M((dp).geom) - lag(ST_M((dp).geom)) OVER (PARTITION BY trip_id ORDER BY (dp).path[1]) AS timedelta
+                    FROM (SELECT trip_id, end_geom, ST_DumpPoints(lines_geom) AS dp FROM %(table)s) AS t),
+                 trips AS (
+                    SELECT trip_id, MAX(ptid) FILTER (WHERE dist>%(safe)s) AS id_last,
+                           bool_and(COALESCE(timedelta>=0, ptid=1)) AS ordered,
+                           count(DISTINCT pingtime) AS npings,
+                           (max(pingtime) - min(pingtime)) / NULLIF(count(DISTINCT pingtime)-1, 0) AS pt_mean,
+                           max(timedelta) FILTER (WHERE timedelta>0) AS pt_max
+                    FROM pts GROUP BY trip_id),
+                 reach AS (  -- pings with the same time are merged in truncateLine(), using their maximum distance
+                    SELECT trip_id, MIN(dist) AS min_dist FROM
+                        (SELECT trip_id, MAX(dist) AS dist FROM pts GROUP BY trip_id, pingtime) AS s
+                    GROUP BY trip_id),
+                 cuts AS (
+                    SELECT p.trip_id, MAX(p.ptid) FILTER (WHERE p.pingtime <= s.pingtime - %(context)s) - 2 AS id_tail,
+                           t.id_last+1 AS id_safe, t.npings, t.pt_mean, t.pt_max
+                    FROM trips t, reach rc, pts s, pts p
+                    WHERE t.ordered AND rc.trip_id=t.trip_id AND rc.min_dist<=%(min)s AND s.trip_id=t.trip_id AND s.ptid=t.id_last+1 AND p.trip_id=t.trip_id AND p.ptid<=t.id_last
+                    GROUP BY p.trip_id, t.id_last, t.npings, t.pt_mean, t.pt_max
+                    HAVING NOT bool_or(p.dist<=%(near)s))
+                 SELECT c.trip_id, c.id_tail, c.id_safe, c.npings, c.pt_mean, c.pt_max, ST_MakeLine(p.geom ORDER BY p.ptid) AS tail_geom
+                 FROM cuts c, pts p
+                 WHERE c.id_tail>1 AND p.trip_id=c.trip_id AND p.ptid>=c.id_tail
+                 GROUP BY c.trip_id, c.id_tail, c.id_safe, c.npings, c.pt_mean, c.pt_max;''' % {
+                 'tails': tailsTn, 'table': self.table, 'safe': max(nearRadius, maxDistThres), 'near': nearRadius, 'min': min([int(r)]+extraRadii()), 'context': rollSecs+2}
         self.db.execute(cmd)
-        self.db.create_indices('lotpolygons', geom='lotgeom')
+        self.db.execute('ALTER TABLE %s ADD PRIMARY KEY (trip_id);' % tailsTn)
 
-    def truncateAllLines(self):
+        nTails, nTailPings, nPings = self.db.execfetch('''SELECT count(*), SUM(ST_NPoints(tail_geom)), SUM(ST_NPoints(lines_geom))
+                                                         FROM %s t, %s tl WHERE t.trip_id=tl.trip_id;''' % (self.table, tailsTn))[0]
+        if nTails>0:
+            self.writeLog('...%d traces pre-truncated, keeping %.0f%% of their points' % (nTails, 100.*nTailPings/nPings))
+
+    def truncateAllLines(self, batchsize=250, useCache=True):
         """Wrapper for truncateLine()
         It is too slow to truncate all lines at once, so we loop over each trace
         It populates a pandas dataframe with the metrics for each trace
         and then uploads the whole dataframe at once
         For some reason (why?) this is more efficient that doing it within postgres
+        batchsize: number of traces to fetch and process at once with truncateLines()
+                   If None, each trace is processed separately with truncateLine()
+        useCache: if True, copy the results for traces that are in the per-trip cache (see copyFromTripCache())
+        The buffer metrics for the additional radii in bufferRadii (see bufferMetrics()) are calculated from the same points
+        They are not part of the fingerprint of this stage, so if bufferRadii changes, calcBufferRadii() fills them in instead
+        If the traces have been pre-truncated (see createTraceTails()), only their tails are processed
+        If narrowTables is True, the metrics are kept in <table>_truncated (see createResultsView()), rather than merged into the trace table
+        The sub-lines (e.g. lbuff_geom) are always in the trace table, because that is where the map matcher reads them from
         """
 
         self.writeLog('Truncating all lines to buffer')
@@ -390,92 +626,164 @@ class traceTable():
         colNames  = ['npings','id_first', 'id_firstx2', 'id_walk', 'id_park', 'maxspeed', 'speed', 'donutspeed', 'walkspeed',
                     'pingtime_meanall', 'pingtime_maxall', 'pingtime_meanbuf', 'pingtime_maxbuf', 'npingsbuf', 'npingsdonut', 'npingswalk', 'pingtime_meanwalk',
                     'pt_maxwalk', 'npingspark']
+        radii = extraRadii()
+        colNames += radiusColumns(radii)
         vectNames = ['lbuff_geom','lineswalk_geom','lineslot_geom','linesall_geom','startpt_geom', 'enterlot_geom','park_geom']
+        resume = self.isResuming('truncate')
         currentCols = self.db.list_columns_in_table(self.table)
-        if any([cc in currentCols for cc in colNames+vectNames]):
-            if self.forceUpdate:
+        if any([cc in currentCols for cc in colNames+vectNames]) or self.hasStageResults('truncate', 'npings'):
+            if self.forceUpdate or resume:  # if resuming, the columns are recreated from the results table
+                self.db.execute('DROP VIEW IF EXISTS %s_lines;' % self.table)
+                if narrowTables:
+                    self.db.execute('DROP VIEW IF EXISTS %s;' % self.resultsTn())
                 dropTxt = ', '.join(['DROP COLUMN IF EXISTS '+cc for cc in colNames+vectNames])
                 self.db.execute('ALTER TABLE %s %s;' % (self.table, dropTxt))
             else:
                 self.writeLog('Lines already truncated. Skipping')
                 return
         nPings = self.getNPings('lines_geom')
-
-        # this is the heart of the function - loop over ides to populate the dataframe
-        ids = [ii for ii in self.getIds() if nPings[ii]>1]
+        done = self.startStage('truncate', resume, self.stageTn('truncate'))
+        useTails = self.table+'_tails' in self.db.list_tables()
+
+        # this is the heart of the function - loop over ides to calculate the metrics for each trace
+        # rows are written to a results table as they arrive, rather than being collected in a dataframe
+        # the results table also lets us resume from where we left off if the stage is interrupted
+        ids = [ii for ii in self.getIds() if nPings[ii]>1 and ii not in done]
+        starttime = time.time()
+        writer = resultsWriter(self.db, self.stageTn('truncate'), [('trip_id','bigint')]+[(cc,'double precision') for cc in colNames],
+                               append=resume, progress=(self.table, 'truncate'))
+        if useCache:  # radii that have not been cached are left Null, and filled in by calcBufferRadii()
+            cacheTn = self.tripCacheName('truncate')
+            cacheCols = self.db.list_columns_in_table(cacheTn) if cacheTn in self.db.list_tables() else []
+            cachedIds = self.copyFromTripCache('truncate', [cc for cc in colNames if cc not in radiusColumns(radii) or cc in cacheCols], writer.tn)
+            ids = [id for id in ids if id not in cachedIds]
         if self.nCores is None: # do in serial
-            df = pd.DataFrame([self.truncateLine(id) for id in ids], columns=['trip_id']+colNames).set_index('trip_id')
+            if batchsize is None:
+                rows = (self.truncateLine(id, radii, useTails) for id in ids)
+            else:
+                rows = (row for ii in range(0, len(ids), batchsize) for row in self.truncateLines(ids[ii:ii+batchsize], radii, useTails))
         else:
             dbtmp = self.db  # can't pass a pyscopg2 object to multiprocessing :(
             self.db = None
-            df = pd.DataFrame(apply_multiprocessing(self.truncateLine, ids, self.nCores)).T
-            df.columns=['trip_id']+colNames
-            for col in df.columns:
-                dt = 'int64' if col=='trip_id' else 'float64'
-                try:
-                    df[col] = df[col].astype(dt)
-                except:
-                    print('did not convert column  {}'.format(col))
-            df.set_index('trip_id', inplace=True)
+            if batchsize is None:
+                results = stream_multiprocessing(self.truncateLine, ((id, radii, useTails) for id in ids), self.nCores, chunksize=100, maxtasksperchild=None, pgLogin=self.pgLogin)
+                rows = (rr for ii, rr in results)
+            else:
+                batches = ((ids[ii:ii+batchsize], radii, useTails) for ii in range(0, len(ids), batchsize))
+                results = stream_multiprocessing(self.truncateLines, batches, self.nCores, maxtasksperchild=None, pgLogin=self.pgLogin)
+                rows = (row for ii, rr in results if rr!=-1 for row in rr)
+        for row in rows:
+            if row!=-1:
+                writer.add(row)
+        if self.nCores is not None:
             self.db = dbtmp # restore the connection
+        nRows = writer.close()
+        self.logTripTiming('Truncating lines', len(ids), time.time()-starttime)
+        if nRows<len(ids):
+            print('{} traces out of {} failed'.format(len(ids)-nRows, len(ids)))
         self.writeLog('...writing to database')
-        self.db.update_table_from_array(df,self.table,joinOnIndices=True)
+        if useCache:
+            self.updateTripCache('truncate', colNames, writer.tn, where='s.npings IS NOT Null')  # not the trips that failed
+        if not narrowTables:  # otherwise, the results table is the narrow table of this stage (see stageTn())
+            self.db.merge_table_into_table(writer.tn, self.table, 'trip_id')
+            self.db.execute('DROP TABLE %s;' % writer.tn)
 
         # Now use the ping id information to extract the relevant portion of the linestring
-        self.db.execute('DROP TABLE IF EXISTS %s_tmpmerge;' % self.table)
-        self.writeLog('...writing temporary table')
-        cmd = '''CREATE TABLE %(table)s_tmpmerge AS
-                 WITH allpts AS (SELECT trip_id, id_first, id_park, id_walk, ST_DumpPoints(lines_geom) AS dp FROM %(table)s)
-                 SELECT t1.trip_id, lbuff_geom, lineswalk_geom, lineslot_geom, linesall_geom,
-                        ST_StartPoint(lbuff_geom)  AS startpt_geom, ST_EndPoint(lbuff_geom) AS enterlot_geom,
-                        ST_EndPoint(lineslot_geom) AS park_geom
-                 FROM
-                    (SELECT trip_id, ST_MakeLine((dp).geom ORDER BY (dp).path[1]) AS lbuff_geom
-                        FROM allpts WHERE (dp).path[1]>=id_first AND (dp).path[1]<=id_park
-                        GROUP BY trip_id) As t1,
-                    (SELECT trip_id, ST_MakeLine((dp).geom ORDER BY (dp).path[1]) AS lineslot_geom
-                        FROM allpts WHERE (dp).path[1]>=id_park AND (dp).path[1]<=id_walk
-                        GROUP BY trip_id) As t2,
-                    (SELECT trip_id, ST_MakeLine((dp).geom ORDER BY (dp).path[1]) AS lineswalk_geom
-                        FROM allpts WHERE (dp).path[1]>=id_walk
-                        GROUP BY trip_id) As t3,
-                    (SELECT trip_id, ST_MakeLine((dp).geom ORDER BY (dp).path[1]) AS linesall_geom
-                        FROM allpts WHERE (dp).path[1]>=id_first
-                        GROUP BY trip_id) As t4
-                  WHERE t1.trip_id = t2.trip_id AND t1.trip_id = t3.trip_id AND t1.trip_id = t4.trip_id;
-                ''' % {'table':self.table}
-        self.db.execute(cmd)
-
-        # if lineslot_geom is Null (no park segment), park_geom is the same as enterlot_geom
-        cmd = '''UPDATE %s_tmpmerge SET park_geom = enterlot_geom WHERE park_geom IS Null;''' % (self.table)
+        # Each trace is dumped once, in a correlated subquery, and sliced by point index, so there is no global temporary table or regrouping
+        # As before, the sub-lines are only added if the buffer, lot and walk segments are all non-empty
+        # If lazyGeometries is True, the sub-lines in lazyLines are not stored, and <table>_lines calculates them on demand instead
+        self.writeLog('...slicing linestrings')
+        sizeBefore = self.tableSize()
+        lines = [ll for ll in subLines if not (lazyGeometries and ll in lazyLines)]
+        cols = [(cc, 'geometry') for cc in lines+['startpt_geom', 'enterlot_geom', 'park_geom']]
+        self.db.addColumns(cols, self.table, dropOld=True)
+        if len(lines)<len(subLines):  # e.g. left from an earlier run without lazyGeometries
+            self.db.execute('ALTER TABLE %s %s;' % (self.table, ', '.join(['DROP COLUMN IF EXISTS '+ll for ll in subLines if ll not in lines])))
+        cmd = '''UPDATE %(table)s t SET
+                    (%(lines)s) =
+                        (SELECT %(slices)s
+                            FROM ST_DumpPoints(lines_geom) AS dp),
+                    startpt_geom = ST_PointN(lines_geom, id_first::int),
+                    enterlot_geom = ST_PointN(lines_geom, id_park::int),
+                    park_geom = COALESCE(ST_PointN(lines_geom, id_walk::int), ST_PointN(lines_geom, id_park::int))
+                 %(from)s WHERE %(sliced)s;
+                ''' % {'table':self.table, 'lines': ', '.join(lines),
+                       'from': 'FROM %s s' % writer.tn if narrowTables else '', 'sliced': ('t.trip_id=s.trip_id AND ' if narrowTables else '')+slicedTripsSql,
+                       'slices': ',\n                                '.join(['ST_MakeLine(dp.geom ORDER BY dp.path[1]) FILTER (WHERE %s)' % sliceFilterSql(*subLines[ll]) for ll in lines])}
         self.db.execute(cmd)
-
-        self.writeLog('...merging')
-        self.db.merge_table_into_table(self.table+'_tmpmerge', self.table, 'trip_id')
-        self.db.execute('DROP TABLE %s_tmpmerge;' % self.table)
+        if lazyGeometries:
+            self.createLinesView()
 
         for geom in ['startpt_geom','park_geom','enterlot_geom','lbuff_geom']:
             self.db.create_indices(self.table, geom=geom)
+        self.writeLog('...trace table size %.1f MB before slicing linestrings, %.1f MB after' % (sizeBefore, self.tableSize()))
+        if narrowTables:
+            self.createResultsView()
+        self.finishStage('truncate')
         self.writeLog('...done')
 
-    def truncateLine(self, id):
+    def lineSql(self, geom):
+        """SQL for geom, one of the sub-lines of lines_geom in subLines
+        This is the column, unless it is not stored (see lazyGeometries), in which case it is sliced from lines_geom on demand"""
+        if geom in self.db.list_columns_in_table(self.table):
+            return geom
+        idFrom, idTo = subLines[geom]
+        return 'CASE WHEN %s THEN trace_slice(lines_geom, %s, %s) END' % (slicedTripsSql, idFrom, 'Null' if idTo is None else idTo)
+
+    def createLinesView(self):
+        """Create trace_slice(), which returns the points of a linestring between two point indexes,
+        and <table>_lines, a view with each of the sub-lines of lines_geom in subLines, whether or not they are stored"""
+        self.db.execute('''CREATE OR REPLACE FUNCTION trace_slice(lines geometry, id_from double precision, id_to double precision) RETURNS geometry AS $$
+                                SELECT ST_MakeLine(dp.geom ORDER BY dp.path[1]) FROM ST_DumpPoints(lines) AS dp
+                                WHERE dp.path[1]>=id_from AND (id_to IS Null OR dp.path[1]<=id_to)
+                           $$ LANGUAGE sql IMMUTABLE;''')
+        # with narrowTables, the point indexes are in the results table of truncateAllLines()
+        fromSql = '%s t LEFT JOIN %s s ON t.trip_id=s.trip_id' % (self.table, self.stageTn('truncate')) if narrowTables else '%s t' % self.table
+        self.db.execute('DROP VIEW IF EXISTS %s_lines;' % self.table)
+        self.db.execute('CREATE VIEW %s_lines AS SELECT t.trip_id, %s FROM %s;' % (
+                            self.table, ', '.join(['%s AS %s' % (self.lineSql(ll), ll) for ll in subLines]), fromSql))
+
+    def tableSize(self):
+        """Size of the trace table on disk (MB), including its TOAST data and indexes"""
+        return self.db.execfetch("SELECT pg_total_relation_size('%s');" % self.table)[0][0]/1e6
+
+    def geometryStorage(self):
+        """Storage (MB) of each geometry column of the trace table, and of the sub-lines that are calculated on demand (see lazyGeometries),
+        if they were stored instead. Use this to compare the disk use with and without lazyGeometries
+        Returns a dataframe indexed by column name, with the MB and whether the column is stored"""
+        geoms = [rr[0] for rr in self.db.execfetch("""SELECT column_name FROM information_schema.columns
+                                                      WHERE table_schema='%s' AND table_name='%s' AND udt_name='geometry';""" % (
+                                                      self.pgLogin['schema'], self.table))]
+        lazy = [ll for ll in subLines if ll not in geoms and self.hasStageResults('truncate', 'id_first')]
+        sizes = self.db.execfetch('SELECT %s FROM %s;' % (', '.join(['COALESCE(SUM(pg_column_size(%s)), 0)/1e6' % self.lineSql(gg) for gg in geoms+lazy]), self.resultsTn()))[0]
+        result = pd.DataFrame({'mb': [float(ss) for ss in sizes], 'stored': [gg in geoms for gg in geoms+lazy]}, index=geoms+lazy)
+        self.writeLog('Geometries: %.1f MB stored, %.1f MB calculated on demand. Trace table: %.1f MB' % (
+                        result.mb[result.stored].sum(), result.mb[~result.stored].sum(), self.tableSize()))
+        return result
+
+    def truncateLine(self, id, radii=(), useTails=False):
         """Extract the portion of linestring after it enters the 400m buffer
         We can't just do an intersect, because the travel path might go out of the buffer afterwards
-        Also take the opportunity to calculate lots of related metrics"""
+        Also take the opportunity to calculate lots of related metrics
+        radii: additional buffer radii, whose metrics are appended to the row (see bufferMetrics())
+        useTails: only fetch the tail of the trace, if it is in the tails table (see createTraceTails())"""
+        radii = extraRadii(radii)
+        nMetrics = 19+len(radiusColumns(radii))
 
         # Get dataframe into pandas. This is more flexible than SQL.
         try:
-            db = mmt.dbConnection(pgLogin=self.pgLogin, verbose=False) # thread safe for parallelization
-            cmd = '''SELECT (dp).path[1] AS ptid, ST_M((dp).geom) AS pingtime,
+            db = getWorkerDb(self.pgLogin) # one connection per worker process, reused for every trip
+            cmd = '''SELECT (dp).path[1]+id_offset AS ptid, ST_M((dp).geom) AS pingtime,
                         ST_Distance(end_geom, (dp).geom) AS disttoend,
-                        ST_Intersects(lotgeom, (dp).geom) AS in_lot,
+                        EXISTS (SELECT 1 FROM %s_lotpolygons l WHERE ST_Intersects(l.lotgeom, (dp).geom)) AS in_lot,
                         (ST_Distance((dp).geom, lag((dp).geom, 1) OVER (PARTITION BY trip_id ORDER BY (dp).path[1]))) AS distdelta,
                         (ST_Distance((dp).geom, lag((dp).geom, 2) OVER (PARTITION BY trip_id ORDER BY (dp).path[1])))::float AS distdelta2,
                         (ST_M((dp).geom) - lag(ST_M((dp).geom), 1) OVER (PARTITION BY trip_id ORDER BY (dp).path[1])) AS timedelta,
                         (ST_M((dp).geom) - lag(ST_M((dp).geom), 2) OVER (PARTITION BY trip_id ORDER BY (dp).path[1])) AS timedelta2
-                        FROM (SELECT trip_id, end_geom, ST_DumpPoints(lines_geom) AS dp
-                                    FROM %s WHERE trip_id=%s) AS t1, lotpolygons;''' % (self.table, id)
-            pointsDf = db.execfetchDf(cmd)
+                        FROM %s AS t1''' % (self.table, self.tracePointsSql('trip_id=$1', useTails))
+            stmt = self.statementName('truncate_tails' if useTails else 'truncate')
+            prepareStatement(db, stmt, 'bigint', cmd)
+            pointsDf = db.execfetchDf('EXECUTE %s(%s);' % (stmt, id))
             pointsDf['timestamp'] = pd.to_datetime(pointsDf.pingtime.apply(lambda x: np.nan if pd.isnull(x) else datetime.datetime.fromtimestamp(x)))
 
             # Smooth out distances for high-resolution traces
@@ -484,7 +792,7 @@ class traceTable():
             # Create lagged values to calculate rolling speed
             # idea is to smooth the speeds so that the speeds are less an artefact of GPS error
             if len(pointsDf)==1:
-                return [id,1]+[np.nan]*18
+                return [id,1]+[np.nan]*(nMetrics-1)
 
             pointsDf.set_index('timestamp', inplace=True)
             if not(pointsDf.index.is_unique):  # some pings have same timestamp, so group by that
@@ -532,105 +840,547 @@ class traceTable():
             donutspeed = pointsDf[donutMask].speed.mean()
             walkspeed  = pointsDf[walkMask].speed.mean() if walkMask.sum()>0 else 'Null'
 
-            return [id, npings, id_first, id_firstx2, id_walk, id_park, maxspeed, speed, donutspeed, walkspeed, pt_mean, pt_max, pt_meanbuf, pt_maxbuf, npingsbuf, npingsdonut, npingswalk, pt_meanwalk, pt_maxwalk, npingspark]
+            radiusMetrics = []
+            for radius in radii:
+                radiusMetrics += bufferMetrics(pointsDf.assign(trip_id=id), radius, pd.Series([id_walk], index=[id]), pd.Series([id_park], index=[id])).iloc[0].tolist()
+
+            row = [id, npings, id_first, id_firstx2, id_walk, id_park, maxspeed, speed, donutspeed, walkspeed, pt_mean, pt_max, pt_meanbuf, pt_maxbuf, npingsbuf, npingsdonut, npingswalk, pt_meanwalk, pt_maxwalk, npingspark] + radiusMetrics
+            return self.tailRows([row], db, radii)[0] if useTails else row
         except:
             print('Failed on id {}'.format(id))
-            return [id]+[np.nan]*19
+            rollbackWorkerDb()
+            return [id]+[np.nan]*nMetrics
+
+    def truncateLines(self, ids, radii=(), useTails=False):
+        """Batch version of truncateLine()
+        Fetches the points for a block of trip_ids in one query, and calculates the metrics for the whole block
+        with grouped pandas operations, rather than setting up a separate dataframe for each trip
+        Returns a list of rows in the same format (and with the same values) as truncateLine()
+        If anything goes wrong, falls back to truncateLine() for each trip in the block"""
+        radii = extraRadii(radii)
+        nMetrics = 19+len(radiusColumns(radii))
+
+        try:
+            db = getWorkerDb(self.pgLogin) # one connection per worker process, reused for every batch
+            cmd = '''SELECT trip_id, (dp).path[1]+id_offset AS ptid, ST_M((dp).geom) AS pingtime,
+                        ST_Distance(end_geom, (dp).geom) AS disttoend,
+                        EXISTS (SELECT 1 FROM %s_lotpolygons l WHERE ST_Intersects(l.lotgeom, (dp).geom)) AS in_lot,
+                        (ST_Distance((dp).geom, lag((dp).geom, 1) OVER (PARTITION BY trip_id ORDER BY (dp).path[1]))) AS distdelta,
+                        (ST_Distance((dp).geom, lag((dp).geom, 2) OVER (PARTITION BY trip_id ORDER BY (dp).path[1])))::float AS distdelta2,
+                        (ST_M((dp).geom) - lag(ST_M((dp).geom), 1) OVER (PARTITION BY trip_id ORDER BY (dp).path[1])) AS timedelta,
+                        (ST_M((dp).geom) - lag(ST_M((dp).geom), 2) OVER (PARTITION BY trip_id ORDER BY (dp).path[1])) AS timedelta2
+                        FROM %s AS t1
+                        ORDER BY trip_id, ptid''' % (self.table, self.tracePointsSql('trip_id = ANY($1)', useTails))
+            stmt = self.statementName('truncate_batch_tails' if useTails else 'truncate_batch')
+            prepareStatement(db, stmt, 'bigint[]', cmd)
+            pointsDf = db.execfetchDf('EXECUTE %s(ARRAY[%s]::bigint[]);' % (stmt, ','.join([str(id) for id in ids])))
+            pointsDf['timestamp'] = pd.to_datetime(pointsDf.pingtime.apply(lambda x: np.nan if pd.isnull(x) else datetime.datetime.fromtimestamp(x)))
+
+            # Smooth out distances for high-resolution traces
+            pointsDf.loc[(pointsDf.timedelta==1) & (pointsDf.timedelta2==2), 'distdelta'] = pointsDf.distdelta2.astype(float)
+
+            # trips with a single ping get no metrics
+            singleIds = pointsDf.groupby('trip_id').size()
+            singleIds = singleIds[singleIds==1].index
+            pointsDf = pointsDf[~pointsDf.trip_id.isin(singleIds)]
+
+            # some pings have same timestamp, so group by that (only for the trips where this happens)
+            dupIds = pointsDf.loc[pointsDf.duplicated(['trip_id','timestamp']), 'trip_id'].unique()
+            if len(dupIds)>0:
+                dupMask = pointsDf.trip_id.isin(dupIds)
+                dupDf = pointsDf[dupMask].groupby(['trip_id','timestamp']).agg({'ptid':'max', 'disttoend':'max', 'in_lot':'min', 'timedelta':'sum', 'distdelta':'sum'}).reset_index()
+                pointsDf = pd.concat([pointsDf[~dupMask], dupDf]).sort_values('trip_id', kind='mergesort') # stable sort keeps the order within each trip
+            pointsDf = pointsDf.reset_index(drop=True)
+            pointsDf.loc[pointsDf.timedelta==0, 'timedelta'] = np.nan # first entry can be zero in pathological cases
+
+            # rolling speed. Equivalent to resampling each trip to 1 second and taking a rolling sum over rollSecs rows,
+            # but only the occupied seconds are kept, so we can use a time-based window
+            pointsDf['tsec'] = pointsDf.timestamp.dt.floor('S')
+            rolled = (pointsDf.groupby(['trip_id','tsec'])[['distdelta','timedelta']].mean().reset_index(level=0)
+                          .groupby('trip_id')[['distdelta','timedelta']].rolling('%ds' % rollSecs, min_periods=1).sum())
+            rolled.index.names = ['trip_id','timestamp']
+            rolled.columns = ['rolldist', 'rolltime']
+            pointsDf = pointsDf.merge(rolled, how='left', left_on=['trip_id','timestamp'], right_index=True).reset_index(drop=True) # like reindex(): Null if the ping is not on a whole second
+
+            pointsDf['rollspeed'] = pointsDf.rolldist/1000./pointsDf.rolltime*60*60
+            pointsDf.loc[pointsDf.groupby('trip_id').timedelta.cumsum()<rollSecs, 'rollspeed'] = np.nan  # gets rid of speeds that are too high because only a few secs are included
+            pointsDf['speed'] = pointsDf.distdelta/pointsDf.timedelta/1000.*60*60 # speed at each ping
+
+            # Calculate metrics for each trip as a whole
+            grouped = pointsDf.groupby('trip_id')
+            tripsDf = pd.DataFrame(index=pd.Index(grouped.size().index, name='trip_id'))
+            tripsDf['npings'] = grouped.size()
+            tripsDf['id_first'] = np.fmax(pointsDf[pointsDf.disttoend<=int(r)].groupby('trip_id').ptid.min().reindex(tripsDf.index)-1, 1)
+            tripsDf['id_firstx2'] = np.fmax(pointsDf[pointsDf.disttoend<=int(r)*2].groupby('trip_id').ptid.min().reindex(tripsDf.index)-1, 1)
+            tripsDf['id_walk'] = pointsDf[pointsDf.rollspeed>wSpeed].groupby('trip_id').ptid.max().reindex(tripsDf.index).fillna(1)
+
+            pointsDf = pointsDf.join(tripsDf[['id_first','id_firstx2','id_walk']], on='trip_id')
+            tmpDf = pointsDf.loc[pointsDf.ptid<=pointsDf.id_walk, ['trip_id','in_lot','ptid']].iloc[::-1] # note the [::-1] is to reverse the order
+            tmpDf = tmpDf[tmpDf.groupby('trip_id').in_lot.cummin()==True]
+            tripsDf['id_park'] = tmpDf.groupby('trip_id').ptid.min().reindex(tripsDf.index)
+            tripsDf.loc[tripsDf.id_park.isnull() | (tripsDf.id_park>tripsDf.id_walk), 'id_park'] = tripsDf.id_walk
+            pointsDf = pointsDf.join(tripsDf[['id_park']], on='trip_id')
+
+            bufMask = (pointsDf.ptid>pointsDf.id_first) & (pointsDf.ptid<=pointsDf.id_walk)   # points within 400m and until the walk segment starts
+            donutMask = (pointsDf.ptid>pointsDf.id_firstx2) & (pointsDf.ptid<=pointsDf.id_first+1)   # points within 800m and until the 400m radius starts.
+            walkMask = pointsDf.ptid>pointsDf.id_walk
+            parkMask = (pointsDf.ptid>pointsDf.id_park) & (pointsDf.ptid<=pointsDf.id_walk)
+
+            # sampling resolution (pt = pingtime)
+            tripsDf['pt_mean'] = grouped.timedelta.mean()
+            tripsDf['pt_max']  = grouped.timedelta.max()
+            for mask, suffix in [(bufMask, 'buf'), (donutMask, 'donut'), (walkMask, 'walk'), (parkMask, 'park')]:
+                tripsDf['npings'+suffix] = mask.groupby(pointsDf.trip_id).sum()
+            bufGrouped, walkGrouped = pointsDf[bufMask].groupby('trip_id'), pointsDf[walkMask].groupby('trip_id')
+            tripsDf['pt_meanbuf'] = bufGrouped.timedelta.mean()
+            tripsDf['pt_maxbuf']  = bufGrouped.timedelta.max()
+            tripsDf['pt_meanwalk'] = walkGrouped.timedelta.mean()
+            tripsDf['pt_maxwalk'] = walkGrouped.timedelta.max()
+            tripsDf['maxspeed']   = bufGrouped.speed.max() # max speed in 400m buffer
+            tripsDf['speed']      = bufGrouped.speed.mean()
+            tripsDf['donutspeed'] = pointsDf[donutMask].groupby('trip_id').speed.mean()
+            tripsDf['walkspeed']  = walkGrouped.speed.mean()
+            tripsDf['walkspeed']  = tripsDf.walkspeed.astype(object).where(tripsDf.npingswalk>0, 'Null')
+
+            cols = ['npings', 'id_first', 'id_firstx2', 'id_walk', 'id_park', 'maxspeed', 'speed', 'donutspeed', 'walkspeed', 'pt_mean', 'pt_max',
+                    'pt_meanbuf', 'pt_maxbuf', 'npingsbuf', 'npingsdonut', 'npingswalk', 'pt_meanwalk', 'pt_maxwalk', 'npingspark']
+
+            # the same metrics for the other radii, from the same points
+            for radius in radii:
+                tripsDf = tripsDf.join(bufferMetrics(pointsDf, radius, tripsDf.id_walk, tripsDf.id_park))
+            cols += radiusColumns(radii)
+
+            results = dict((id, [id]+row) for id, row in zip(tripsDf.index, tripsDf[cols].values.tolist()))
+            results.update(dict((id, [id,1]+[np.nan]*(nMetrics-1)) for id in singleIds))
+            rows = [results[id] if id in results else [id]+[np.nan]*nMetrics for id in ids]
+            return self.tailRows(rows, db, radii) if useTails else rows
+        except:
+            print('Failed on batch of {} trips starting with id {}. Processing one at a time'.format(len(ids), ids[0]))
+            rollbackWorkerDb()
+            return [self.truncateLine(id, radii, useTails) for id in ids]
+
+    def tracePointsSql(self, where, useTails=False):
+        """Subquery with the points of each trace (as dp), for the trips that meet the condition in where
+        With useTails, traces that are in the tails table only have the points in their tail (see createTraceTails())
+        id_offset is the number of points that are left out, so that (dp).path[1]+id_offset is the position of the point in lines_geom"""
+        if not useTails:
+            return '(SELECT trip_id, end_geom, 0 AS id_offset, ST_DumpPoints(lines_geom) AS dp FROM %s WHERE %s)' % (self.table, where)
+        return '''(SELECT t.trip_id, t.end_geom, COALESCE(tl.id_tail-1, 0) AS id_offset, ST_DumpPoints(COALESCE(tl.tail_geom, t.lines_geom)) AS dp
+                   FROM %s t LEFT JOIN %s_tails tl ON t.trip_id=tl.trip_id WHERE t.%s)''' % (self.table, self.table, where)
+
+    def tailRows(self, rows, db, radii=()):
+        """Completes the rows from truncateLine() or truncateLines() for the trips that were processed from their tails
+        The number of pings and the ping times for the whole trace are taken from the tails table
+        If id_walk or id_park is before the safe radius, the rolling speeds and parking lot points that the tail leaves out
+        might have changed it, so those trips are processed again with the whole trace"""
+        ids = [row[0] for row in rows]
+        tails = dict((rr[0], rr[1:]) for rr in db.execfetch('SELECT trip_id, id_safe, npings, pt_mean, pt_max FROM %s_tails WHERE trip_id IN (%s);' % (
+                        self.table, ','.join([str(id) for id in ids]))))
+        redoIds = []
+        for row in rows:
+            if row[0] not in tails:
+                continue
+            idSafe, npings, ptMean, ptMax = tails[row[0]]
+            if not (row[4]>=idSafe and row[5]>=idSafe):  # also true if the trip failed
+                redoIds.append(row[0])
+                continue
+            row[1], row[10], row[11] = npings, np.nan if ptMean is None else ptMean, np.nan if ptMax is None else ptMax
+        if len(redoIds)==0:
+            return rows
+        redone = dict((row[0], row) for row in self.truncateLines(redoIds, radii))
+        return [redone.get(row[0], row) for row in rows]
+
+    def calcBufferRadii(self, batchsize=250):
+        """Fill in the buffer metrics for the additional radii in bufferRadii (see bufferMetrics()) for the trips that don't have them
+        truncateAllLines() calculates these from the same points as the metrics for radius r, so there is only anything to do here
+        if bufferRadii has changed since the lines were truncated, or for trips that were copied from the per-trip cache before a radius was added
+        This is a separate stage so that changing bufferRadii does not invalidate the truncation, and so the map matching
+        The metrics are added to the results of truncateAllLines(), i.e. the trace table, or <table>_truncated if narrowTables is True"""
+        radii = extraRadii()
+        if len(radii)==0:
+            return
+        targetTn = self.stageTn('truncate') if narrowTables else self.table
+        colNames = radiusColumns(radii)
+        self.db.addColumns([(cc, 'double precision') for cc in colNames], targetTn, skipIfExists=True)
+
+        # id_first is never Null for a trip with more than one ping (see bufferMetrics())
+        ids = [rr[0] for rr in self.db.execfetch('SELECT trip_id FROM %s WHERE npings>1 AND (%s) ORDER BY trip_id;' % (
+                                                    targetTn, ' OR '.join(['id_first_%d IS Null' % radius for radius in radii])))]
+        if len(ids)==0:
+            self.writeLog('Buffer metrics for radii %s already calculated. Skipping' % ', '.join([str(rr) for rr in radii]))
+            return
+        self.writeLog('Calculating buffer metrics for radii %s for %d trips' % (', '.join([str(rr) for rr in radii]), len(ids)))
+        starttime = time.time()
+        writer = resultsWriter(self.db, self.table+'_bufferradii', [('trip_id','bigint')]+[(cc,'double precision') for cc in colNames])
+        batches = [(ids[ii:ii+batchsize], radii) for ii in range(0, len(ids), batchsize)]  # the tails may not cover a new radius, so they are not used
+        if self.nCores is None:
+            rows = (row for batch in batches for row in self.truncateLines(*batch))
+        else:
+            dbtmp = self.db  # can't pass a pyscopg2 object to multiprocessing :(
+            self.db = None
+            results = stream_multiprocessing(self.truncateLines, batches, self.nCores, maxtasksperchild=None, pgLogin=self.pgLogin)
+            rows = (row for ii, rr in results if rr!=-1 for row in rr)
+        for row in rows:
+            if row!=-1:
+                writer.add([row[0]]+row[-len(colNames):])
+        if self.nCores is not None:
+            self.db = dbtmp # restore the connection
+        writer.close()
+        self.logTripTiming('Buffer metrics for additional radii', len(ids), time.time()-starttime)
+        self.db.execute('UPDATE %s t SET (%s) = (%s) FROM %s s WHERE t.trip_id=s.trip_id;' % (
+                            targetTn, ', '.join(colNames), ', '.join(['s.'+cc for cc in colNames]), writer.tn))
+        self.db.execute('DROP TABLE %s;' % writer.tn)
+        if narrowTables:
+            self.createResultsView()
 
     def addTimeStamps(self):
         """Calculate basic data on time/date of endpoint"""
         cols = [('endtime', 'timestamp with time zone'), ('endhour', 'int'), ('endminute', 'int'),
                 ('weekday', 'boolean')]
-        if 'endtime' in self.db.list_columns_in_table(self.table):
+        if self.hasStageResults('timestamps', 'endtime'):
             if self.forceUpdate:
-                dropTxt = ', '.join(['DROP COLUMN IF EXISTS '+cc[0] for cc in cols])
-                self.db.execute('ALTER TABLE %s %s;' % (self.table, dropTxt))
+                self.dropStageResults('timestamps', cols)
             else:
                 self.writeLog('Timestamps already added. Skipping')
                 return
 
-        self.db.addColumns(cols, self.table, dropOld=True)
-
-        self.db.execute('UPDATE %s SET endtime = to_timestamp(ST_M(ST_EndPoint(lbuff_geom)));' % (self.table))
-
-        self.db.execute('UPDATE %s SET endhour = EXTRACT(hour FROM endtime), endminute = EXTRACT(minute FROM endtime)' % (self.table))
-        self.db.execute('UPDATE %s SET weekday = False;' % self.table)
-        self.db.execute('UPDATE %s SET weekday = True WHERE EXTRACT(dow FROM endtime)>0 AND EXTRACT(dow FROM endtime)<6;' % self.table)
-
-        # now reverse that for holidays.
+        # weekday is reversed for holidays.
         # only metered holidays are New Year, Thanksgiving and Christmas
-        cmd = '''UPDATE %s SET weekday = False
-                        WHERE to_char(endtime, 'MM-DD') in ('01-01', '12-25')
-                              OR to_char(endtime, 'YY-MM-DD') IN
-                              ('2013-11-28', '2014-11-27', '2015-11-26', '2016-11-24', '2017-11-23',
-                               '2018-11-22', '2019-11-28', '2020-11-26', '2021-11-25', '2022-11-24',
-                               '2023-11-23', '2024-11-28', '2025-11-27')''' % self.table
-        self.db.execute(cmd)
-
-    def mapMatchinParallel(self, chunksize=1000):
-        """Parallelized version of self.mapMatch()"""
-        if 'matched_line' in self.db.list_columns_in_table(self.table) and not self.forceUpdate:
-            self.writeLog('Map matched geom_way column already exists. Skipping')
+        cmd = '''SELECT endtime, EXTRACT(hour FROM endtime) AS endhour, EXTRACT(minute FROM endtime) AS endminute,
+                        COALESCE(EXTRACT(dow FROM endtime)>0 AND EXTRACT(dow FROM endtime)<6
+                                 AND NOT (to_char(endtime, 'MM-DD') in ('01-01', '12-25')
+                                          OR to_char(endtime, 'YY-MM-DD') IN
+                                          ('2013-11-28', '2014-11-27', '2015-11-26', '2016-11-24', '2017-11-23',
+                                           '2018-11-22', '2019-11-28', '2020-11-26', '2021-11-25', '2022-11-24',
+                                           '2023-11-23', '2024-11-28', '2025-11-27')), False) AS weekday
+                 FROM (SELECT to_timestamp(ST_M(ST_EndPoint(lbuff_geom))) AS endtime) AS e'''
+        self.writeStageResults('timestamps', cols, cmd)
+
+    def downsampleTraces(self):
+        """Thin lbuff_geom to lbuff_geom_thin, which is then map matched instead, if downsampleSpacing or downsampleSecs is set
+        The cost of map matching grows with the number of pings, and high-frequency (e.g. 1 Hz) traces have many more than are needed
+        Turns, and the first and last ping, are always kept. See downsampleSql()"""
+        currentCols = self.db.list_columns_in_table(self.table)
+        if downsampleSpacing is None and downsampleSecs is None:
+            if 'lbuff_geom_thin' in currentCols:  # so that lbuff_geom is matched again
+                self.db.execute('ALTER TABLE %s DROP COLUMN lbuff_geom_thin;' % self.table)
             return
-        newCols = ['matched_line', 'lbuff_geom_cleaned', 'edge_ids','match_score']
-        for col in newCols:
-            self.db.execute('ALTER TABLE {} DROP COLUMN IF EXISTS {};'.format(self.table, col))
-
-        # There are economies of scale in a mapmatcher instance, so split into chunks of chunksize
-        nPings = self.getNPings()
-        chunkIndices = np.array_split(list(nPings.keys()), math.ceil(len(nPings)/chunksize))
+        if 'lbuff_geom_thin' in currentCols:
+            if self.forceUpdate:
+                self.db.execute('ALTER TABLE %s DROP COLUMN lbuff_geom_thin;' % self.table)
+            else:
+                self.writeLog('Traces already downsampled. Skipping')
+                return
+        self.writeLog('Downsampling traces before map matching')
+        self.db.execute("SELECT AddGeometryColumn('%s','lbuff_geom_thin',%s,'LineStringM',3);" % (self.table, self.srs))
+        self.db.execute(downsampleSql(self.table, downsampleSpacing, downsampleSecs, downsampleTurnAngle))
+        nPings, nThinPings = self.db.execfetch('SELECT SUM(ST_NPoints(lbuff_geom)), SUM(ST_NPoints(lbuff_geom_thin)) FROM %s;' % self.table)[0]
+        if nPings:
+            self.writeLog('...kept %d of %d pings (%.0f%%)' % (nThinPings, nPings, 100.*nThinPings/nPings))
+
+    def benchmarkDownsampling(self, settings=None, nTrips=200):
+        """Compare the throughput and match quality of map matching with different downsampling settings, on a random sample of nTrips traces
+        settings: list of (spacing, secs) tuples (see downsampleSpacing and downsampleSecs). (None, None) is the full-resolution trace
+        Returns a dataframe with one row per setting, with the pings and seconds per trace, the mean match score, and,
+        compared to the full-resolution match, the median ratio of the matched distances and the mean fraction of its edges that are matched
+        The traces are copied to <table>_dsbench, so the trace table is not changed"""
+        settings = [(None, None), (10, None), (25, None), (50, None), (None, 5), (None, 10)] if settings is None else settings
+        if (None, None) not in settings:
+            settings = [(None, None)] + settings
+        benchTn = self.table+'_dsbench'
+        self.db.execute('DROP TABLE IF EXISTS %s;' % benchTn)
+        self.db.execute('CREATE TABLE %s AS SELECT trip_id, lbuff_geom FROM %s WHERE ST_NPoints(lbuff_geom)>=3 ORDER BY random() LIMIT %d;' % (benchTn, self.table, nTrips))
+        self.db.execute('ALTER TABLE %s ADD PRIMARY KEY (trip_id);' % benchTn)
+        for col, geomType in [('lbuff_geom_thin', 'LineStringM'), ('matched_line', 'LineString'), ('lbuff_geom_cleaned', 'LineStringM')]:
+            self.db.execute("SELECT AddGeometryColumn('%s','%s',%s,'%s',%d);" % (benchTn, col, self.srs, geomType, 3 if geomType.endswith('M') else 2))
+        self.db.addColumns([('edge_ids', 'int[]'), ('match_score', 'real')], benchTn)
+        ids = [rr[0] for rr in self.db.execfetch('SELECT trip_id FROM %s ORDER BY trip_id;' % benchTn)]
+
+        mmtdb = mmt.dbConnection(pgLogin=self.pgLogin, verbose=False)
+        setStatementTimeout(mmtdb, mapmatch_timeout)
+        matches, rows = {}, []
+        for spacing, secs in settings:
+            if spacing is None and secs is None:
+                self.db.execute('UPDATE %s SET lbuff_geom_thin = lbuff_geom;' % benchTn)
+            else:
+                self.db.execute(downsampleSql(benchTn, spacing, secs, downsampleTurnAngle))
+            self.db.execute('UPDATE %s SET %s;' % (benchTn, ', '.join([cc+'=Null' for cc in matchedCols])))
+            mapMatcher = mm.mapMatcher(self.streets, benchTn, 'trip_id', 'lbuff_geom_thin', db=mmtdb, verbose=False, cleanedGeomName='lbuff_geom_cleaned', qualityModelFn=coeffFn)
+            starttime = time.time()
+            for id in ids:
+                try:
+                    matchTraceWithTimeout(mapMatcher, id, mapmatch_timeout)
+                    if mapMatcher.matchStatus==0:
+                        mapMatcher.writeMatchToPostgres()
+                except Exception as e:
+                    self.writeLog('Benchmark: failed on trace %s with spacing %s and secs %s: %s' % (id, spacing, secs, e))
+            seconds = time.time()-starttime
+            matches[(spacing, secs)] = self.db.execfetchDf('''SELECT trip_id, ST_NPoints(lbuff_geom_thin) AS npings, ST_Length(matched_line) AS matchdist,
+                                                                 edge_ids, match_score FROM %s;''' % benchTn).set_index('trip_id')
+            rows.append([spacing, secs, matches[(spacing, secs)].npings.mean(), seconds/len(ids), matches[(spacing, secs)].match_score.mean()])
+            self.writeLog('Benchmark: spacing %s, secs %s: %.2f seconds per trace' % (spacing, secs, seconds/len(ids)))
+        self.db.execute('DROP TABLE %s;' % benchTn)
+
+        full = matches[(None, None)]
+        for row, (spacing, secs) in zip(rows, settings):
+            df = matches[(spacing, secs)]
+            edgeOverlap = [len(set(ee) & set(ff))/float(len(set(ff))) for ee, ff in zip(df.edge_ids, full.edge_ids.reindex(df.index))
+                           if isinstance(ee, list) and isinstance(ff, list) and len(ff)>0]
+            row += [(df.matchdist / full.matchdist.reindex(df.index)).median(), np.mean(edgeOverlap) if len(edgeOverlap)>0 else np.nan]
+        return pd.DataFrame(rows, columns=['spacing', 'secs', 'npings', 'secs_per_trace', 'match_score', 'matchdist_ratio', 'frc_edges_matched'])
+
+    def mapMatchinParallel(self, chunksize=1000, chunksPerCore=8, useCache=True):
+        """Parallelized version of self.mapMatch()
+        chunksize: maximum number of traces passed to each mapmatcher instance
+        chunksPerCore: the traces are split into about this many chunks of equal estimated cost per core
+                       More chunks means that a slow chunk holds up the end of the stage for less time
+        useCache: if True, copy the matches for traces that are in the per-trip cache (see copyFromTripCache())"""
+        resume = self.isResuming('mapmatch')
+        if not resume:
+            if 'matched_line' in self.db.list_columns_in_table(self.table) and not self.forceUpdate:
+                self.writeLog('Map matched geom_way column already exists. Skipping')
+                return
+            newCols = ['matched_line', 'lbuff_geom_cleaned', 'edge_ids','match_score']
+            for col in newCols:
+                self.db.execute('ALTER TABLE {} DROP COLUMN IF EXISTS {};'.format(self.table, col))
+
+        # There are economies of scale in a mapmatcher instance, so split into chunks of up to chunksize traces
+        # The chunks are balanced by estimated cost, rather than by number of traces, so that all cores finish at about the same time
+        nPings = self.getNPings(matchGeomName(self.db, self.table))
+        done = self.startStage('mapmatch', resume)
+        self.createMapMatchLedgers(keep=resume)
+        # need to pre-create the columns, because otherwise the different parallel threads will get confused as to who is doing it
+        self.addMatchedColumns()
+        if resume:  # traces that failed or timed out are retried at the end, as before
+            done |= self.getMapMatchLedgerIds()
+        if useCache:
+            done |= self.copyFromTripCache('mapmatch', matchedCols)
+        rejected = self.rejectTrips('mapmatch') if earlyRejection else set()
+        nPings = OrderedDict((id, nn) for id, nn in nPings.items() if id not in done and id not in rejected)
+        chunkIds = self.balanceMapMatchChunks(self.getMapMatchCosts(nPings), chunksize, chunksPerCore)
         # list of OrderedDicts, each of which will be passed to self.mapMatch()
-        subDicts = [OrderedDict((rr,nPings[rr]) for rr in chunk ) for chunk in chunkIndices ]
+        subDicts = [OrderedDict((rr,nPings[rr]) for rr in chunk ) for chunk in chunkIds ]
         print('Starting parallel mapmatching')
 
-        # need to pre-create the columns, because otherwise the different parallel threads will get confused as to who is doing it
-        self.db.execute("SELECT AddGeometryColumn('%s','matched_line',%s,'LineString',2);" % (self.table, self.srs))
-        self.db.execute("SELECT AddGeometryColumn('%s','lbuff_geom_cleaned',%s,'LineStringM',3);" % (self.table, self.srs))
-        self.db.addColumns([('edge_ids', 'int[]'), ('match_score', 'real')], self.table)
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s_mmtiming (trip_id bigint PRIMARY KEY, npings int, seconds real);' % self.table)
+        for tn in self.db.list_tables():  # left behind by workers that were interrupted
+            if tn.startswith(self.table+'_mmstaging_'):
+                self.db.execute('DROP TABLE %s;' % tn)
 
-        result = apply_multiprocessing(mapMatch_wrapper, zip(subDicts, [self.streets]*len(subDicts),[self.table]*len(subDicts), [self.db.default_schema]*len(subDicts)), self.nCores)
+        # the chunks are submitted most expensive first, and idle workers take the next chunk from the queue as they finish
+        # maxInFlight=nCores means that a chunk is only handed to the pool once a worker is free for it
+        starttime = time.time()
+        result = dict(stream_multiprocessing(mapMatch_wrapper, zip(subDicts, [self.streets]*len(subDicts),[self.table]*len(subDicts), [self.db.default_schema]*len(subDicts)),
+                                             self.nCores, maxInFlight=self.nCores))
         failed_chunks = [ii for ii, rr in result.items() if rr!=0]
         if len(failed_chunks)==0:
             print('All mapmatching chunks succeeded!')
         else:
-            print('Redoing {} of {} failed chunks in serial'.format(len(subDicts), len(failed_chunks)))
+            print('{} of {} chunks failed. Retrying their traces individually'.format(len(failed_chunks), len(subDicts)))
             for ii in failed_chunks:
-                result = mapMatch_wrapper(subDicts[ii], self.streets, self.table)
-                success = 'succeeded' if result==0 else 'failed'
-                print('Chunk {} {}'.format(ii, success))
-
-    def mapMatchinSerial(self):
+                self.recordChunkFailure(subDicts[ii])
+        self.logRejectionSavings('Map matching', len(rejected), len(nPings), time.time()-starttime)
+        self.retryFailedTraces()
+        self.retryQuarantinedTraces()
+        if useCache:
+            self.updateTripCache('mapmatch', matchedCols, where='t.matched_line IS NOT Null')
+        self.finishStage('mapmatch')
+
+    def addMatchedColumns(self):
+        """Add the columns written by the mapmatcher (see matchedCols), if they don't already exist"""
+        currentCols = self.db.list_columns_in_table(self.table)
+        if 'matched_line' not in currentCols:
+            self.db.execute("SELECT AddGeometryColumn('%s','matched_line',%s,'LineString',2);" % (self.table, self.srs))
+        if 'lbuff_geom_cleaned' not in currentCols:
+            self.db.execute("SELECT AddGeometryColumn('%s','lbuff_geom_cleaned',%s,'LineStringM',3);" % (self.table, self.srs))
+        self.db.addColumns([('edge_ids', 'int[]'), ('match_score', 'real')], self.table, skipIfExists=True)
+
+    def getMapMatchCosts(self, nPings, overhead=20):
+        """Estimated cost of map matching each trace, used to balance the chunks in mapMatchinParallel()
+        The cost is the number of pings in lbuff_geom, plus a fixed overhead per trace (in pings)
+        If a trace has been matched before, its time in <table>_mmtiming (written by mapMatch_wrapper()) is used instead,
+        converted to pings using the average time per ping of all the timed traces"""
+        costs = OrderedDict((id, overhead+nn) for id, nn in nPings.items())
+        if self.table+'_mmtiming' not in self.db.list_tables():
+            return costs
+        timing = self.db.execfetchDf('SELECT trip_id, npings, seconds FROM %s_mmtiming;' % self.table)
+        timing = timing[timing.trip_id.isin(list(costs.keys()))]
+        if len(timing)==0 or timing.seconds.sum()<=0:
+            return costs
+        secsPerPing = timing.seconds.sum() / (timing.npings+overhead).sum()
+        for id, seconds in zip(timing.trip_id, timing.seconds):
+            costs[id] = seconds / secsPerPing
+        self.writeLog('Using previous mapmatching times for %d of %d traces' % (len(timing), len(costs)))
+        return costs
+
+    def balanceMapMatchChunks(self, costs, chunksize=1000, chunksPerCore=8):
+        """Split the traces into chunks of about equal estimated cost, with at most chunksize traces each
+        costs: OrderedDict of trip_id: estimated cost
+        The traces are sorted most expensive first, and the chunks are returned in decreasing order of cost,
+        so that the longest chunks are started first and the short ones fill in the gaps at the end"""
+        nCores = 1 if self.nCores is None else self.nCores
+        target = sum(costs.values()) / float(max(1, nCores*chunksPerCore))
+        chunks, chunk, chunkCost = [], [], 0
+        for id in sorted(costs, key=lambda x: -costs[x]):
+            if len(chunk)>0 and (chunkCost+costs[id]>target or len(chunk)>=chunksize):
+                chunks.append((chunkCost, sorted(chunk)))
+                chunk, chunkCost = [], 0
+            chunk.append(id)
+            chunkCost += costs[id]
+        if len(chunk)>0:
+            chunks.append((chunkCost, sorted(chunk)))
+        chunks.sort(key=lambda x: -x[0])
+        if len(chunks)>0:
+            self.writeLog('Split %d traces into %d mapmatching chunks. Estimated cost per chunk: max %d, median %d, min %d' % (
+                len(costs), len(chunks), chunks[0][0], chunks[len(chunks)//2][0], chunks[-1][0]))
+        return [cc[1] for cc in chunks]
+
+    def mapMatchinSerial(self, useCache=True):
         # create a db connection object with a timeout
-        mmtdb = mmt.dbConnection(pgLogin=self.pgLogin, verbose=False) # timeout=mapmatch_timeout, verbose=False)
+        mmtdb = mmt.dbConnection(pgLogin=self.pgLogin, verbose=False)
+        setStatementTimeout(mmtdb, mapmatch_timeout)
 
-        mapMatcher = mm.mapMatcher(self.streets, self.table, 'trip_id', 'lbuff_geom', db=mmtdb, verbose=False, cleanedGeomName='lbuff_geom_cleaned',qualityModelFn='mapmatching_coefficients.txt')
+        mapMatcher = mm.mapMatcher(self.streets, self.table, 'trip_id', matchGeomName(mmtdb, self.table), db=mmtdb, verbose=False, cleanedGeomName='lbuff_geom_cleaned',qualityModelFn='mapmatching_coefficients.txt')
         mapMatcher.db.verbose=False
-        if 'matched_line' in mmtdb.list_columns_in_table(self.table) and not self.forceUpdate:
+        resume = self.isResuming('mapmatch')
+        if 'matched_line' in mmtdb.list_columns_in_table(self.table) and not self.forceUpdate and not resume:
             self.writeLog('Map matched geom_way column already exists. Skipping')
             return -1
-        nPings = self.getNPings()
+        nPings = self.getNPings(matchGeomName(mmtdb, self.table))
         assert isinstance(nPings, OrderedDict)
+        done = self.startStage('mapmatch', resume)
+        self.createMapMatchLedgers(keep=resume)
+        if resume:
+            done |= self.getMapMatchLedgerIds()
+        if useCache:
+            self.addMatchedColumns()
+            done |= self.copyFromTripCache('mapmatch', matchedCols)
+        rejected = self.rejectTrips('mapmatch') if earlyRejection else set()
+        done |= rejected
 
         starttime=time.time()
+        matched = []  # traces that have been matched, but not yet recorded in the progress table
         for ii,id in enumerate(nPings):
+            if id in done:
+                continue
+            if len(matched)>=100:
+                mmtdb.execute(progressSql(self.table, 'mapmatch', matched))
+                matched = []
             if nPings[id]>=3:  # need at least 3 points to match a trace
                 if ii%100==0: self.writeLog('Matching trace %s (#%d of %d)' % (id,ii,len(nPings)))
                 try:
-                    mapMatcher.matchPostgresTrace(id)
+                    tracestart = time.time()
+                    matchTraceWithTimeout(mapMatcher, id, mapmatch_timeout)
                     if mapMatcher.matchStatus==0:
                         mapMatcher.writeMatchToPostgres()
+                    matched.append(id)
                 except Exception as e:
-                    self.writeLog('***FAILED ON trace %s (#%d of %d)***' % (id,ii,len(nPings)))
-                    self.writeLog(str(e))
+                    if isTimeout(e):
+                        self.writeLog('***TIMED OUT ON trace %s (#%d of %d). Quarantining it***' % (id,ii,len(nPings)))
+                        quarantineTrace(mmtdb, self.table, id, nPings[id], time.time()-tracestart, mapmatch_timeout)
+                    else:
+                        self.writeLog('***FAILED ON trace %s (#%d of %d)***' % (id,ii,len(nPings)))
+                        self.writeLog(str(e))
+                        recordFailure(mmtdb, self.table, [(id, nPings[id])], str(e), time.time()-tracestart)
             else:
                 self.writeLog('Cannot map match trace %s - too few points' % (id))
 
+        mmtdb.execute(progressSql(self.table, 'mapmatch', matched))
+        self.logRejectionSavings('Map matching', len(rejected), len([id for id in nPings if id not in done]), time.time()-starttime)
         print('Mapmatching took %d seconds, of which:' % (time.time()-starttime))
         for k,v in mapMatcher.timing.items():
             if k!='median_times': print('\t%s: %d seconds' % (k,v))
 
+        self.retryFailedTraces()
+        self.retryQuarantinedTraces()
+        if useCache:
+            self.updateTripCache('mapmatch', matchedCols, where='t.matched_line IS NOT Null')
+        self.finishStage('mapmatch')
         return 0
 
+    def createMapMatchLedgers(self, keep=False):
+        """Tables of the traces that took longer than mapmatch_timeout to map match (see quarantineTrace()),
+        and of the traces that failed (see recordFailure())
+        keep: if True, keep any existing tables, e.g. when resuming"""
+        if not keep:
+            self.db.execute('DROP TABLE IF EXISTS %s_mmquarantine;' % self.table)
+            self.db.execute('DROP TABLE IF EXISTS %s_mmfailures;' % self.table)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS %s_mmquarantine (trip_id bigint PRIMARY KEY, npings int, seconds real, timeout real,
+                                                                        attempts int, resolved boolean);''' % self.table)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS %s_mmfailures (trip_id bigint PRIMARY KEY, npings int, error text, attempts int,
+                                                                      seconds real, resolved boolean);''' % self.table)
+
+    def getMapMatchLedgerIds(self):
+        """Set of trip_ids in the quarantine or failure ledgers"""
+        result = self.db.execfetch('SELECT trip_id FROM %(table)s_mmquarantine UNION SELECT trip_id FROM %(table)s_mmfailures;' % {'table': self.table})
+        return set([rr[0] for rr in result])
+
+    def recordChunkFailure(self, pingDict):
+        """When a whole chunk fails (e.g. the worker lost its connection), add the traces in it that the map matching stage has not completed
+        or quarantined to the failure ledger, so that they are retried by retryFailedTraces()
+        Completed traces include those that pgMapMatch declined to match, which have no matched_line
+        Traces that are already in the ledger were recorded by the worker itself, so their attempts are not incremented again"""
+        ids = [id for id in pingDict if pingDict[id]>=3]
+        if len(ids)==0:
+            return
+        unmatched = self.db.execfetch('''SELECT trip_id FROM %(table)s WHERE trip_id IN (%(ids)s)
+                                          AND trip_id NOT IN (SELECT trip_id FROM %(table)s_progress WHERE stage='mapmatch')
+                                          AND trip_id NOT IN (SELECT trip_id FROM %(table)s_mmquarantine)
+                                          AND trip_id NOT IN (SELECT trip_id FROM %(table)s_mmfailures);''' % {
+                                          'table': self.table, 'ids': ','.join([str(id) for id in ids])})
+        recordFailure(self.db, self.table, [(rr[0], pingDict[rr[0]]) for rr in unmatched], 'chunk failed', np.nan)
+
+    def retryFailedTraces(self, maxAttempts=3, chunksize=10):
+        """Retry the traces in the failure ledger, in parallel and in small chunks, so that one bad trace doesn't hold up the others
+        Each trace is attempted at most maxAttempts times (including the first). Traces that time out are left to retryQuarantinedTraces()"""
+        for attempt in range(1, maxAttempts):
+            failed = self.db.execfetch('''SELECT trip_id, npings FROM %(table)s_mmfailures WHERE NOT resolved AND attempts<%(maxAttempts)d
+                                            AND trip_id NOT IN (SELECT trip_id FROM %(table)s_mmquarantine) ORDER BY trip_id;''' % {
+                                            'table': self.table, 'maxAttempts': maxAttempts})
+            if len(failed)==0:
+                break
+            self.writeLog('Retrying %d failed traces (retry %d of %d)' % (len(failed), attempt, maxAttempts-1))
+            subDicts = [OrderedDict(failed[ii:ii+chunksize]) for ii in range(0, len(failed), chunksize)]
+            args = [(subDict, self.streets, self.table, self.db.default_schema, None, True) for subDict in subDicts]
+            if self.nCores is None:
+                results = {}
+                for ii, aa in enumerate(args):
+                    try:
+                        results[ii] = mapMatch_wrapper(*aa)
+                    except Exception as e:
+                        print(e)
+                        results[ii] = -1
+            else:
+                results = apply_multiprocessing(mapMatch_wrapper, args, self.nCores)
+            for ii, rr in results.items():
+                if rr!=0:
+                    self.recordChunkFailure(subDicts[ii])
+
+        nFailed, nResolved = self.db.execfetch('SELECT count(*), count(*) FILTER (WHERE resolved) FROM %s_mmfailures;' % self.table)[0]
+        if nFailed>0:
+            self.writeLog('%d of %d failed traces were matched on retry. See %s_mmfailures' % (nResolved, nFailed, self.table))
+
+    def retryQuarantinedTraces(self, timeoutFactor=4, coresFactor=4, chunksize=10):
+        """Retry the traces that timed out in the main mapmatching pass, after everything else has been matched
+        They get a longer time limit (mapmatch_timeout*timeoutFactor), and fewer cores (nCores/coresFactor)
+        so that they don't compete with each other for memory
+        Traces that time out again stay in <table>_mmquarantine with resolved=False, and are not matched"""
+        quarantined = self.db.execfetch('SELECT trip_id, npings FROM %s_mmquarantine WHERE NOT resolved ORDER BY trip_id;' % self.table)
+        if len(quarantined)==0:
+            return
+        timeout = mapmatch_timeout*timeoutFactor
+        nCores = None if self.nCores is None else self.nCores//coresFactor
+        self.writeLog('Retrying %d traces that timed out, with a time limit of %d seconds' % (len(quarantined), timeout))
+        subDicts = [OrderedDict(quarantined[ii:ii+chunksize]) for ii in range(0, len(quarantined), chunksize)]
+        args = [(subDict, self.streets, self.table, self.db.default_schema, timeout, True) for subDict in subDicts]
+        if nCores is None or nCores<=1:
+            for aa in args:
+                mapMatch_wrapper(*aa)
+        else:
+            apply_multiprocessing(mapMatch_wrapper, args, nCores)
+        nResolved = self.db.execfetch('SELECT count(*) FROM %s_mmquarantine WHERE resolved;' % self.table)[0][0]
+        self.writeLog('%d of %d quarantined traces were matched on retry. See %s_mmquarantine' % (nResolved, len(quarantined), self.table))
+
     def addMapMatchedSupplementaryData(self):
         """Given the map matched results, add new columns that will speed subsequent processing"""
         # add quality columns
@@ -666,37 +1416,257 @@ class traceTable():
 
         return
 
-    def calcAllNetworkDistances(self):
-        if 'netwkdist' in self.db.list_columns_in_table(self.table):
-            if self.forceUpdate:
+    def calcAllNetworkDistances(self, method=None, chunksize=5000, useCache=True):
+        """Network distance from the start edge to the end edge of each trip
+        method: defaults to routingMethod
+                'pgr_trsp' calls pgRouting separately for each trip (see calcNetworkDistance())
+                'pgr_trsp_bbox' does the same, but only passes the streets near the trip to pgRouting (see calcNetworkDistanceInEnvelope())
+                'inprocess' loads the street graph and turn restrictions once per worker, and routes in python (see cruising_routing.py),
+                            giving up on routes that cost more than routingMaxCost. See benchmarkRouting() to compare it with pgRouting
+        chunksize: number of trips passed to each worker when method is 'inprocess'
+        useCache: if True, copy the distances for trips in the per-trip cache (see copyFromTripCache()),
+                  and look up routes that have already been solved (in any trace table in this region) in the
+                  network distance cache, and only route the others. See lookupNetworkDistanceCache()
+        """
+        method = routingMethod if method is None else method
+        assert method in ['pgr_trsp', 'pgr_trsp_bbox', 'inprocess']
+        resume = self.isResuming('netwkdist')
+        if self.hasStageResults('netwkdist', 'netwkdist'):
+            if narrowTables and (self.forceUpdate or resume):  # the results table is kept if resuming
+                self.db.execute('DROP VIEW IF EXISTS %s;' % self.resultsTn())
+            elif self.forceUpdate or resume:  # if resuming, the column is recreated from the results table
                 self.db.execute('ALTER TABLE %s DROP COLUMN netwkdist;' % (self.table))
             else:
                 print('Network distances already calculated. Skipping')
                 return
 
         # avoid calculating network distance for trips where map-matching failed
+        done = self.startStage('netwkdist', resume, self.table+'_netwkdist')
         ids = self.db.execfetch('SELECT trip_id FROM %s WHERE matched_line IS NOT Null;' % (self.table))
-        ids = sorted([ii[0] for ii in ids])
-
-        if self.nCores is None:
-            df = pd.DataFrame([self.calcNetworkDistance(id) for id in ids], columns=['trip_id','netwkdist']).set_index('trip_id')
+        rejected = self.rejectTrips('netwkdist') if earlyRejection else set()
+        ids = sorted([ii[0] for ii in ids if ii[0] not in done and ii[0] not in rejected])
+
+        # distances are written to a results table as they arrive, rather than being collected in a dataframe
+        writer = resultsWriter(self.db, self.table+'_netwkdist', [('trip_id','bigint'), ('netwkdist','double precision')],
+                               append=resume, progress=(self.table, 'netwkdist'))
+        if useCache:
+            cachedIds = self.copyFromTripCache('netwkdist', ['netwkdist'], writer.tn)
+            ids = [id for id in ids if id not in cachedIds]
+            cached = self.lookupNetworkDistanceCache(ids)
+            cachedIds = set(cached.index)
+            ids = [id for id in ids if id not in cachedIds]
+
+        if method=='pgr_trsp_bbox':  # the restrictions are filtered by target_id for each trip
+            self.db.execute('CREATE INDEX IF NOT EXISTS {region}_turn_restrictions_target_id_idx ON {region}_turn_restrictions (target_id);'.format(region=self.region))
+            self.getMinCostPerMeter()  # calculated once, before the workers are started
+        routingFunction = self.calcNetworkDistanceInEnvelope if method=='pgr_trsp_bbox' else self.calcNetworkDistance
+
+        if useCache:
+            for row in cached.netwkdist.items():
+                writer.add(row)
+        starttime = time.time()
+        if method=='inprocess':
+            results = self.calcNetworkDistancesInProcess(ids, chunksize)
+        elif self.nCores is None:
+            results = (routingFunction(id) for id in ids)
         else:  # in parallel
             dbtmp = self.db  # can't pass a pyscopg2 object to multiprocessing :(
             self.db = None
-            result = apply_multiprocessing(self.calcNetworkDistance, ids, self.nCores)
-            #df = pd.DataFrame(result.values(), columns=['trip_id','netwkdist']).set_index('trip_id') # not robust to failures
-            df = pd.DataFrame(result, index=['trip_id','netwkdist']).T
-            df_failed = df[df.trip_id==-1]
-            df = df[df.trip_id!=-1]  # these are trips that failed
-            print('{} trips out of {} failed. Here are the first few:'.format(len(df_failed), len(df)))
-            print(df_failed.head())
-            df.set_index('trip_id', inplace=True)
-
+            results = (rr for ii, rr in stream_multiprocessing(routingFunction, ids, self.nCores, chunksize=100, maxtasksperchild=None, pgLogin=self.pgLogin))
+        nFailed = 0
+        for result in results:
+            if result==-1:  # these are trips that failed
+                nFailed += 1
+            else:
+                writer.add(result)
+        if self.nCores is not None and method!='inprocess':
             self.db = dbtmp # restore the connection
-        self.db.update_table_from_array(df,self.table,joinOnIndices=True)
-        self.db.execute('DROP TABLE tmp_for_insertion_%s' % self.table)
-        # some errors
-        self.db.execute('UPDATE %s SET netwkdist=Null WHERE netwkdist>1e6' % self.table)
+        writer.close()
+        if nFailed>0:
+            print('{} trips out of {} failed'.format(nFailed, len(ids)))
+        if method!='inprocess':
+            self.logTripTiming('Network distances', len(ids), time.time()-starttime)
+        self.logRejectionSavings('Network distances', len(rejected), len(ids), time.time()-starttime)
+        if narrowTables:  # the results table becomes the narrow table of this stage (see stageTn())
+            self.db.execute('UPDATE %s SET netwkdist=Null WHERE netwkdist>1e6' % writer.tn)
+            self.createResultsView()
+        else:
+            self.db.merge_table_into_table(writer.tn, self.table, 'trip_id')
+            self.db.execute('DROP TABLE %s;' % writer.tn)
+            # some errors
+            self.db.execute('UPDATE %s SET netwkdist=Null WHERE netwkdist>1e6' % self.table)
+        if useCache:
+            self.updateNetworkDistanceCache(ids)
+            if narrowTables:
+                self.updateTripCache('netwkdist', ['netwkdist'], writer.tn, where='s.netwkdist IS NOT Null')
+            else:
+                self.updateTripCache('netwkdist', ['netwkdist'], where='t.netwkdist IS NOT Null')
+        self.finishStage('netwkdist')
+
+    def rejectTrips(self, stage):
+        """Early rejection: apply the cheap filters in defineUsableTrips() before stage, so that it can skip the trips that would be discarded anyway
+        Before map matching ('mapmatch'), the ping time filters are applied to lbuff_geom, which is the trace that is matched
+        Before routing ('netwkdist'), the match score and the class of the end edge are also known
+        The filters are applied in turn, and each trip is recorded in <table>_rejected with the first filter that removed it
+        defineUsableTrips() still applies all the filters, so the rejected trips are never usable (but have no matched_line or netwkdist)
+        Returns the set of rejected trip_ids"""
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s_rejected (trip_id bigint PRIMARY KEY, filter text, stage text);' % self.table)
+        self.db.execute("DELETE FROM %s_rejected WHERE stage='%s';" % (self.table, stage))
+
+        pingtimes = '''(SELECT trip_id, MAX(pingtime - prevtime) AS pingtime_max FROM
+                            (SELECT trip_id, ST_M((dp).geom) AS pingtime, lag(ST_M((dp).geom)) OVER (PARTITION BY trip_id ORDER BY (dp).path[1]) AS prevtime
+                             FROM (SELECT trip_id, ST_DumpPoints(lbuff_geom) AS dp FROM %s) AS t) AS pts
+                         GROUP BY trip_id)''' % self.table
+        filters = [('pingtime_mean', 'SELECT trip_id FROM %s WHERE (ST_M(ST_EndPoint(lbuff_geom)) - ST_M(ST_StartPoint(lbuff_geom))) / NULLIF(ST_NPoints(lbuff_geom)-1, 0) > 30' % self.table),
+                   ('pingtime_max', 'SELECT trip_id FROM %s AS pt WHERE pingtime_max > 60' % pingtimes)]
+        if stage=='netwkdist':
+            filters += [('match_score', 'SELECT trip_id FROM %s WHERE match_score <= %s' % (self.table, qualityCutoff)),
+                        ('end_clazz', 'SELECT trip_id FROM %s, %s WHERE edge_id_end=id AND clazz=11' % (self.table, self.streets))]
+
+        for name, filterSql in filters:
+            nRejected = self.db.execfetch('''WITH inserted AS (INSERT INTO %(table)s_rejected (trip_id, filter, stage) SELECT trip_id, '%(name)s', '%(stage)s' FROM (%(sql)s) AS f
+                                                ON CONFLICT DO NOTHING RETURNING 1)
+                                             SELECT count(*) FROM inserted;''' % {'table': self.table, 'name': name, 'stage': stage, 'sql': filterSql})[0][0]
+            self.writeLog('...%s filter removed %d trips before %s' % (name, nRejected, stage))
+        return set([rr[0] for rr in self.db.execfetch('SELECT trip_id FROM %s_rejected;' % self.table)])
+
+    def logRejectionSavings(self, stage, nRejected, nTrips, seconds):
+        """Log the time saved by rejecting trips early, estimated from the time per trip of the trips that were processed"""
+        if nRejected>0 and nTrips>0:
+            self.writeLog('%s: skipped %d rejected trips, saving about %d seconds' % (stage, nRejected, nRejected*seconds/nTrips))
+
+    def getStreetsVersion(self):
+        """Fingerprint of the streets and turn restrictions tables, so that cached routes are not reused if the network changes"""
+        cmd = '''SELECT md5(count(*)::text || '_' || max(id)::text || '_' || sum(source::bigint+target::bigint)::text || '_' ||
+                            round(sum(cost)::numeric, 3)::text || '_' || round(sum(reverse_cost)::numeric, 3)::text || '_' ||
+                            (SELECT count(*) FROM %s_turn_restrictions)::text)
+                 FROM %s;''' % (self.region, self.streets)
+        return self.db.execfetch(cmd)[0][0]
+
+    def tripCacheName(self, stage):
+        return '%s_tripcache_%s' % (self.region, stage)
+
+    def tripHashSql(self, stage, alias='t'):
+        """SQL for the key of a trip in the per-trip results cache for stage
+        This is a hash of its lines_geom and end_geom, and of the fingerprint of the stage (see stageFingerprints()),
+        so trips are only found in the cache if the trace and everything that the stage depends on are unchanged"""
+        fingerprint = self.currentFingerprint if self.currentFingerprint is not None else self.stageFingerprints()[stage]
+        return "md5(ST_AsEWKB(%(a)s.lines_geom) || COALESCE(ST_AsEWKB(%(a)s.end_geom), ''::bytea) || convert_to('%(fp)s', 'UTF8'))" % {
+                    'a': alias, 'fp': fingerprint}
+
+    def copyFromTripCache(self, stage, columns, targetTn=None):
+        """Copy the results of stage from the per-trip cache for this region, for the trips in this table that have been
+        processed before (e.g. in an overlapping extract loaded into another trace table) and have not been done in this run
+        columns: the result columns in the cache
+        targetTn: results table (with trip_id and columns) to insert the results into. If None, the columns in this table are updated
+        The trips are recorded as completed (see startStage()). Returns the set of trip_ids that were found in the cache"""
+        cacheTn = self.tripCacheName(stage)
+        if cacheTn not in self.db.list_tables():
+            return set()
+        if any([cc not in self.db.list_columns_in_table(cacheTn) for cc in columns]):
+            return set()  # e.g. results for additional buffer radii have not been cached before
+        hitsTn = self.table+'_cachehits'
+        self.db.execute('DROP TABLE IF EXISTS %s;' % hitsTn)
+        self.db.execute('''CREATE UNLOGGED TABLE %(hits)s AS
+                            SELECT t.trip_id, c.trip_hash, %(ccols)s FROM %(table)s t, %(cache)s c
+                            WHERE %(hash)s=c.trip_hash
+                              AND t.trip_id NOT IN (SELECT trip_id FROM %(table)s_progress WHERE stage='%(stage)s');''' % {
+                            'hits': hitsTn, 'table': self.table, 'cache': cacheTn, 'hash': self.tripHashSql(stage), 'stage': stage,
+                            'ccols': ', '.join(['c.'+cc for cc in columns])})
+        if targetTn is None:
+            cmd = 'UPDATE %s t SET %s FROM %s h WHERE t.trip_id=h.trip_id;' % (self.table, ', '.join(['%s=h.%s' % (cc, cc) for cc in columns]), hitsTn)
+        else:
+            cmd = 'INSERT INTO %s (trip_id, %s) SELECT trip_id, %s FROM %s ON CONFLICT DO NOTHING;' % (targetTn, ', '.join(columns), ', '.join(columns), hitsTn)
+        cmd += '''INSERT INTO %(table)s_progress (stage, trip_id) SELECT '%(stage)s', trip_id FROM %(hits)s ON CONFLICT DO NOTHING;
+                  UPDATE %(cache)s SET last_used=now() WHERE trip_hash IN (SELECT trip_hash FROM %(hits)s);''' % {
+                  'table': self.table, 'stage': stage, 'hits': hitsTn, 'cache': cacheTn}
+        self.db.execute(cmd)  # one statement, so that the results and progress are written together
+
+        hits = set([rr[0] for rr in self.db.execfetch('SELECT trip_id FROM %s;' % hitsTn)])
+        self.db.execute('DROP TABLE %s;' % hitsTn)
+        self.writeLog('Per-trip cache for %s: %d trips copied' % (stage, len(hits)))
+        return hits
+
+    def updateTripCache(self, stage, columns, sourceTn=None, where='True'):
+        """Add the results of stage to the per-trip cache for this region, and drop the least recently used trips if it is too large
+        columns: the result columns to cache
+        sourceTn: table with trip_id and the result columns. If None, they are taken from this table
+        where: condition on the trips to add, e.g. to exclude trips that failed"""
+        cacheTn = self.tripCacheName(stage)
+        src = 't' if sourceTn is None else 's'
+        fromSql = '%s t' % self.table if sourceTn is None else '%s t, %s s' % (self.table, sourceTn)
+        if sourceTn is not None:
+            where = 't.trip_id=s.trip_id AND (%s)' % where
+        if cacheTn not in self.db.list_tables():
+            self.db.execute('''CREATE TABLE %s AS SELECT ''::text AS trip_hash, now() AS last_used, %s FROM %s WITH NO DATA;''' % (
+                                cacheTn, ', '.join(['%s.%s' % (src, cc) for cc in columns]), fromSql))
+            self.db.execute('ALTER TABLE %s ADD PRIMARY KEY (trip_hash);' % cacheTn)
+            self.db.execute('CREATE INDEX IF NOT EXISTS {tn}_last_used_idx ON {tn} (last_used);'.format(tn=cacheTn))
+        else:  # add any columns that are not in the cache yet (e.g. for additional buffer radii)
+            cacheCols = self.db.list_columns_in_table(cacheTn)
+            types = dict(self.db.execfetch("""SELECT column_name, udt_name FROM information_schema.columns
+                                               WHERE table_schema='%s' AND table_name='%s';""" % (self.pgLogin['schema'], self.table if sourceTn is None else sourceTn)))
+            newCols = [(cc, types[cc]) for cc in columns if cc not in cacheCols]
+            if len(newCols)>0:
+                self.db.addColumns(newCols, cacheTn, skipIfExists=True)
+        self.db.execute('''INSERT INTO %s (trip_hash, last_used, %s) SELECT %s, now(), %s FROM %s WHERE %s
+                           ON CONFLICT DO NOTHING;''' % (cacheTn, ', '.join(columns), self.tripHashSql(stage),
+                           ', '.join(['%s.%s' % (src, cc) for cc in columns]), fromSql, where))
+
+        nRows = self.db.execfetch('SELECT count(*) FROM %s;' % cacheTn)[0][0]
+        if nRows>tripCacheMaxRows:
+            self.writeLog('Dropping %d least recently used trips from the per-trip cache for %s' % (nRows-tripCacheMaxRows, stage))
+            self.db.execute('''DELETE FROM %s WHERE ctid IN
+                                (SELECT ctid FROM %s ORDER BY last_used LIMIT %d);''' % (cacheTn, cacheTn, nRows-tripCacheMaxRows))
+
+    def createNetworkDistanceCache(self):
+        """Create the network distance cache table for this region, if it doesn't already exist
+        Routes are keyed by the streets table version, start and end edge, and the rounded positions along them"""
+        cacheTn = self.region+'_netwkdist_cache'
+        self.db.execute('''CREATE TABLE IF NOT EXISTS %s (
+                            streets_version text, edge_id_start bigint, edge_id_end bigint, stfr_q int, endfr_q int,
+                            netwkdist double precision, hits int DEFAULT 0, last_used timestamp with time zone DEFAULT now(),
+                            PRIMARY KEY (streets_version, edge_id_start, edge_id_end, stfr_q, endfr_q));''' % cacheTn)
+        self.db.execute('CREATE INDEX IF NOT EXISTS {tn}_last_used_idx ON {tn} (last_used);'.format(tn=cacheTn))
+        return cacheTn
+
+    def lookupNetworkDistanceCache(self, ids):
+        """Returns a dataframe of the network distances of trips (in ids) whose route is already in the cache,
+        and marks those routes as used"""
+        cacheTn = self.createNetworkDistanceCache()
+        self.streetsVersion = self.getStreetsVersion()
+        idsTn = self.createIdsTable(ids)
+        inputsSql = self.getRoutingInputsSql(idsTn)
+        whereSql = '''c.streets_version='%(version)s' AND c.edge_id_start=i.edge_id_start AND c.edge_id_end=i.edge_id_end
+                      AND c.stfr_q=round(i.stfr*%(step)s)::int AND c.endfr_q=round(i.endfr*%(step)s)::int''' % {'version':self.streetsVersion, 'step':netwkdistCacheStep}
+        cached = self.db.execfetchDf('SELECT i.trip_id, c.netwkdist FROM (%s) AS i, %s AS c WHERE %s;' % (inputsSql, cacheTn, whereSql)).set_index('trip_id')
+        # only the routes of these trips are marked as used, so that the least recently used routes are the ones dropped
+        self.db.execute('UPDATE %s AS c SET hits=hits+1, last_used=now() FROM (%s) AS i WHERE %s;' % (cacheTn, inputsSql, whereSql))
+        self.db.execute('DROP TABLE %s;' % idsTn)
+        self.writeLog('Network distance cache: %d hits of %d trips (%.1f%%)' % (len(cached), len(ids), 100.*len(cached)/max(len(ids),1)))
+        return cached
+
+    def updateNetworkDistanceCache(self, ids):
+        """Add newly routed trips to the network distance cache, and drop the least recently used routes if it is too large
+        ids: the trips that were routed in this run. Trips whose distance came from either cache, or that failed, are not added"""
+        cacheTn = self.createNetworkDistanceCache()
+        if len(ids)==0:
+            return
+        idsTn = self.createIdsTable(ids)
+        cmd = '''INSERT INTO %(cacheTn)s (streets_version, edge_id_start, edge_id_end, stfr_q, endfr_q, netwkdist)
+                    SELECT '%(version)s', i.edge_id_start, i.edge_id_end, round(i.stfr*%(step)s)::int, round(i.endfr*%(step)s)::int, t.netwkdist
+                    FROM (%(inputs)s) AS i, %(table)s AS t
+                    WHERE i.trip_id=t.trip_id AND t.matched_line IS NOT Null AND t.netwkdist IS NOT Null
+                 ON CONFLICT DO NOTHING;''' % {'inputs':self.getRoutingInputsSql(idsTn), 'cacheTn':cacheTn, 'table':self.resultsTn(),
+                                                'version':self.streetsVersion, 'step':netwkdistCacheStep}
+        self.db.execute(cmd)
+        self.db.execute('DROP TABLE %s;' % idsTn)
+
+        nRows = self.db.execfetch('SELECT count(*) FROM %s;' % cacheTn)[0][0]
+        if nRows>netwkdistCacheMaxRows:
+            self.writeLog('Dropping %d least recently used routes from the network distance cache' % (nRows-netwkdistCacheMaxRows))
+            self.db.execute('''DELETE FROM %s WHERE ctid IN
+                                (SELECT ctid FROM %s ORDER BY last_used, hits LIMIT %d);''' % (cacheTn, cacheTn, nRows-netwkdistCacheMaxRows))
 
     def calcNetworkDistance(self,id):
         """Returns network distance from start edge to end edge"""
@@ -710,7 +1680,7 @@ class traceTable():
         # but we'd have to nest this in a function
         # right now, scales fairly linearly at 0.06/sec per trip
 
-        db = mmt.dbConnection(pgLogin=self.pgLogin, verbose=False) # thread safe for parallelization
+        db = getWorkerDb(self.pgLogin) # one connection per worker process, reused for every trip
         cmd = '''SELECT trip_id, (SELECT SUM(pgr.cost/r3.cost*ST_Length(r3.geom_way)) AS length
                     FROM pgr_trsp('SELECT id::int4, source::int4, target::int4, cost::float8, reverse_cost::float8 FROM %(sts)s',
                             edge_id_start, stfr, edge_id_end, endfr, True, True,
@@ -720,79 +1690,230 @@ class traceTable():
                           ST_LineLocatePoint(r2.geom_way, ST_EndPoint(t.lbuff_geom)) AS endfr
                        FROM %(sts)s AS r1, %(sts)s AS r2, %(table)s as t
                         WHERE t.edge_ids[1] = r1.id AND t.edge_id_end = r2.id
-                            AND edge_ids[1] is not Null AND edge_id_end is not null AND trip_id=%(id)s) AS trips;
-                            ''' % {'sts':self.streets, 'region':self.region, 'table':self.table, 'id':id}
+                            AND edge_ids[1] is not Null AND edge_id_end is not null AND trip_id=$1) AS trips
+                            ''' % {'sts':self.streets, 'region':self.region, 'table':self.table}
         try:
-            dist = db.execfetch(cmd)[0][1]
+            prepareStatement(db, self.statementName('netwkdist'), 'bigint', cmd)
+            dist = db.execfetch('EXECUTE %s(%s);' % (self.statementName('netwkdist'), id))[0][1]
         except:  # some trips fail with an error because path not found
            dist = np.nan
+           rollbackWorkerDb()  # in case the failed query aborted the transaction
         return (id, dist)
 
-    def addOtherDistances(self):
+    def calcNetworkDistanceInEnvelope(self, id, buffers=None):
+        """Same as calcNetworkDistance(), but pgRouting only builds a graph of the streets (and turn restrictions)
+        within an envelope around the start and end edges, so the time per trip doesn't grow with the size of the region
+        buffers: list of distances (meters) to expand the envelope by. Defaults to routingBuffers
+        The next (larger) envelope is tried if no path is found, if the path is implausible (>1e6, e.g. wrong way on a one-way street),
+        or if a cheaper path might leave the envelope. pgRouting minimizes the cost, not the length, so a path is only accepted
+        if its cost is no more than that of the cheapest possible detour out of the envelope and back, i.e. twice the buffer at the
+        lowest cost per meter of any street (see getMinCostPerMeter())
+        If all of these fail, we route on the whole network"""
+        buffers = routingBuffers if buffers is None else buffers
+
+        db = getWorkerDb(self.pgLogin) # one connection per worker process, reused for every trip
+        minCostPerMeter = self.getMinCostPerMeter(db)
+        cmd = '''SELECT edge_ids[1] AS edge_id_start, edge_id_end,
+                          ST_LineLocatePoint(r1.geom_way, t.startpt_geom) AS stfr,
+                          ST_LineLocatePoint(r2.geom_way, ST_EndPoint(t.lbuff_geom)) AS endfr,
+                          ST_XMin(bbox), ST_YMin(bbox), ST_XMax(bbox), ST_YMax(bbox)
+                       FROM %(sts)s AS r1, %(sts)s AS r2, %(table)s as t,
+                            LATERAL (SELECT ST_Extent(geom) AS bbox FROM (SELECT r1.geom_way AS geom UNION ALL SELECT r2.geom_way) AS g) AS b
+                        WHERE t.edge_ids[1] = r1.id AND t.edge_id_end = r2.id
+                            AND edge_ids[1] is not Null AND edge_id_end is not null AND trip_id=$1
+                            ''' % {'sts':self.streets, 'table':self.table}
+        try:
+            prepareStatement(db, self.statementName('netwkdist_inputs'), 'bigint', cmd)
+            edge_id_start, edge_id_end, stfr, endfr, xmin, ymin, xmax, ymax = db.execfetch('EXECUTE %s(%s);' % (self.statementName('netwkdist_inputs'), id))[0]
+        except:  # no start or end edge
+            return (id, np.nan)
+
+        # the SQL for the edges and turn restrictions is passed to pgr_trsp as text parameters
+        cmd = '''SELECT SUM(pgr.cost/r3.cost*ST_Length(r3.geom_way)) AS length, SUM(pgr.cost) AS cost
+                    FROM pgr_trsp($1, $2, $3, $4, $5, True, True, $6) as pgr, %s as r3 WHERE id2=r3.id''' % self.streets
+
+        for buffer in buffers+[None]:
+            if buffer is None:
+                edgeFilter = ''
+            else:
+                edgeFilter = ' WHERE geom_way && ST_MakeEnvelope(%s, %s, %s, %s, %s)' % (xmin-buffer, ymin-buffer, xmax+buffer, ymax+buffer, self.srs)
+            restrictionFilter = '' if buffer is None else ' WHERE target_id IN (SELECT id FROM %s%s)' % (self.streets, edgeFilter)
+            args = {'sts':self.streets, 'region':self.region, 'edgeFilter':edgeFilter, 'restrictionFilter':restrictionFilter,
+                    'edge_id_start':edge_id_start, 'stfr':stfr, 'edge_id_end':edge_id_end, 'endfr':endfr}
+            try:
+                prepareStatement(db, self.statementName('netwkdist_bbox'), 'text, int4, float8, int4, float8, text', cmd)
+                dist, cost = db.execfetch('''EXECUTE %(name)s('SELECT id::int4, source::int4, target::int4, cost::float8, reverse_cost::float8 FROM %(sts)s%(edgeFilter)s',
+                                        %(edge_id_start)s, %(stfr)s, %(edge_id_end)s, %(endfr)s,
+                                        'SELECT to_cost::float8, target_id::int4,source_id::text AS via_path FROM %(region)s_turn_restrictions%(restrictionFilter)s');
+                                    ''' % dict(args, name=self.statementName('netwkdist_bbox')))[0]
+            except:  # path not found. Roll back in case the failed query aborted the transaction
+                rollbackWorkerDb()
+                db = getWorkerDb(self.pgLogin)  # a new connection, if the old one had to be dropped
+                dist, cost = None, None
+            if buffer is None:
+                return (id, np.nan if dist is None else dist)
+            if dist is not None and dist<=1e6 and cost<=2*buffer*minCostPerMeter:
+                return (id, dist)
+
+    def getMinCostPerMeter(self, db=None):
+        """Lowest cost per meter of any street, in either direction, used to bound the routing in calcNetworkDistanceInEnvelope()
+        This is only calculated once, and is then kept (and passed to the worker processes)"""
+        if self.minCostPerMeter is None:
+            db = self.db if db is None else db
+            self.minCostPerMeter = db.execfetch('''SELECT MIN(c/ST_Length(geom_way)) FROM %s, LATERAL (VALUES (cost), (reverse_cost)) AS v(c)
+                                                   WHERE c>0 AND ST_Length(geom_way)>0;''' % self.streets)[0][0]
+        return self.minCostPerMeter
+
+    def getRoutingInputsSql(self, idsTn=None):
+        """SQL for the start and end edge of each trip, and the fractional position along each edge
+        These are the same inputs that calcNetworkDistance() passes to pgr_trsp
+        idsTn: if given, only the trips in this table of trip_ids (see createIdsTable())"""
+        idSql = '' if idsTn is None else ' AND trip_id IN (SELECT trip_id FROM %s)' % idsTn
+        return '''SELECT trip_id, edge_ids[1] AS edge_id_start, edge_id_end,
+                          ST_LineLocatePoint(r1.geom_way, t.startpt_geom) AS stfr,
+                          ST_LineLocatePoint(r2.geom_way, ST_EndPoint(t.lbuff_geom)) AS endfr
+                       FROM %(sts)s AS r1, %(sts)s AS r2, %(table)s as t
+                        WHERE t.edge_ids[1] = r1.id AND t.edge_id_end = r2.id
+                            AND edge_ids[1] is not Null AND edge_id_end is not null%(idSql)s
+                            ''' % {'sts':self.streets, 'table':self.table, 'idSql':idSql}
+
+    def getRoutingInputs(self, idsTn=None):
+        """Returns a dataframe with the routing inputs for each trip (see getRoutingInputsSql())"""
+        return self.db.execfetchDf(self.getRoutingInputsSql(idsTn)+';')
+
+    def createIdsTable(self, ids):
+        """Loads a list of trip_ids into a temporary table, so that queries can join against it
+        rather than having every id spliced into the SQL. Returns the name of the table, which lasts until it is dropped or the connection is closed"""
+        idsTn = self.table+'_ids'
+        self.db.execute('DROP TABLE IF EXISTS %s; CREATE TEMPORARY TABLE %s (trip_id bigint PRIMARY KEY);' % (idsTn, idsTn))
+        cursor = self.db.connection.cursor()
+        cursor.copy_expert('COPY %s (trip_id) FROM STDIN;' % idsTn, io.StringIO(''.join(['%d\n' % id for id in ids])))
+        self.db.connection.commit()
+        return idsTn
+
+    def calcNetworkDistancesInProcess(self, ids, chunksize=5000):
+        """Alternative to calcNetworkDistance() that uses the in-process routing engine in cruising_routing.py
+        The routing inputs are fetched in one query, and each worker loads the street graph once
+        Trips that share a start edge are routed together with one one-to-many search
+        This is a generator that yields (trip_id, netwkdist) tuples as each chunk is routed"""
+        idsTn = self.createIdsTable(ids)
+        inputs = self.getRoutingInputs(idsTn).sort_values(['edge_id_start','trip_id'])  # so that trips with the same start edge are in the same chunk
+        self.db.execute('DROP TABLE %s;' % idsTn)
+        trips = list(inputs[['trip_id','edge_id_start','stfr','edge_id_end','endfr']].itertuples(index=False, name=None))
+        chunks = [trips[ii:ii+chunksize] for ii in range(0, len(trips), chunksize)]
+        restrictionsTn = self.region+'_turn_restrictions'
+        if self.nCores is None:
+            results = (networkDistance_wrapper(chunk, self.streets, restrictionsTn, self.db.default_schema, routingMaxCost) for chunk in chunks)
+        else:
+            results = (rr for ii, rr in stream_multiprocessing(networkDistance_wrapper, [(chunk, self.streets, restrictionsTn, self.db.default_schema, routingMaxCost) for chunk in chunks],
+                                                                 self.nCores, maxtasksperchild=None)) # keep the router loaded
+        routed, nFailed = set(), 0
+        for rr in results:
+            if rr==-1:
+                nFailed += 1
+                continue
+            for row in rr:
+                routed.add(row[0])
+                yield row
+        if nFailed>0:
+            print('{} of {} routing chunks failed'.format(nFailed, len(chunks)))
+        for id in ids:  # trips with no start or end edge are Null, as with calcNetworkDistance()
+            if id not in routed:
+                yield (id, np.nan)
+
+    def benchmarkRouting(self, nTrips=200, maxCost=None, tolerance=1):
+        """Compare the in-process router (see calcNetworkDistancesInProcess()) with pgRouting on a random sample of nTrips trips,
+        to check that they give the same network distances before switching routingMethod, and compare their speed
+        maxCost: see routingMaxCost, which is the default
+        tolerance: distances (meters) that differ by no more than this agree
+        Returns a dataframe with one row per trip (see cruising_routing.compareWithPgRouting()). The trace table is not changed"""
+        maxCost = routingMaxCost if maxCost is None else maxCost
+        inputs = self.getRoutingInputs()
+        inputs = inputs.sample(min(nTrips, len(inputs))).sort_values('trip_id')
+        trips = list(inputs[['trip_id','edge_id_start','stfr','edge_id_end','endfr']].itertuples(index=False, name=None))
+        restrictionsTn = self.region+'_turn_restrictions'
+
+        starttime = time.time()
+        router = cr.loadRouter(self.db, self.streets, restrictionsTn, maxCost=maxCost)
+        loadSecs = time.time()-starttime
+        result = cr.compareWithPgRouting(self.db, router, trips, self.streets, restrictionsTn, tolerance)
+
+        self.writeLog('Routing benchmark: %d trips. pgRouting: %.3f seconds per trip. In-process: %.3f seconds per trip, plus %.1f seconds to load the graph' % (
+                        len(result), result.pgr_secs.mean(), result.inprocess_secs.mean(), loadSecs))
+        self.writeLog('Routing benchmark: %d of %d trips agree within %s m. %d are only routed by pgRouting, %d only in-process. Largest difference %.1f m' % (
+                        result.agree.sum(), len(result), tolerance, (result.pgr_dist.notnull() & result.inprocess_dist.isnull()).sum(),
+                        (result.pgr_dist.isnull() & result.inprocess_dist.notnull()).sum(), result['diff'].abs().max()))
+        return result
+
+    def addOtherDistances(self, radii=None):
+        """radii: additional buffer radii (see bufferMetrics()), for which max_dist, cruise and high_cruise are also calculated
+        For these, the excess distance is still from the map-matched line for radius r, but max_dist and frc_inbuffer
+        are for the portion of the trace within each radius (frc_inbuffer_<radius> is from the GPS points, see bufferMetrics())"""
+        radii = extraRadii(radii)
         cols = [('max_dist', 'real'), ('walklength', 'real'), ('walkdist', 'real'), ('parkdist','real'),
                 ('dist_ratio','real'), ('frc_inbuffer','real'), ('start_end_dist','real'), ('cruise_time','real'),
                 ('cruise','boolean'), ('high_cruise','boolean'),]
-        if 'max_dist' in self.db.list_columns_in_table(self.table):
+        cols += [cc for radius in radii for cc in [('max_dist_%d' % radius, 'real'), ('cruise_%d' % radius, 'boolean'), ('high_cruise_%d' % radius, 'boolean')]]
+        if self.hasStageResults('otherdistances', 'max_dist'):
             if self.forceUpdate:
-                dropTxt = ', '.join(['DROP COLUMN IF EXISTS '+cc[0] for cc in cols])
-                self.db.execute('ALTER TABLE %s %s;' % (self.table, dropTxt))
+                self.dropStageResults('otherdistances', cols)
             else:
                 self.writeLog('Other distances already added. Skipping')
                 return
-        self.db.addColumns(cols, self.table, dropOld=True)
 
         self.writeLog('\tCalculating distances and ratios')
 
-        # max distance from end point
-        cmd = '''UPDATE %s t1 SET max_dist = distance FROM
-                (SELECT trip_id, MAX(ST_Distance((dp).geom, end_geom)) AS distance FROM
-                    (SELECT trip_id, end_geom, ST_DumpPoints(lbuff_geom) AS dp FROM %s) AS pts
-                GROUP BY trip_id) AS t2
-            WHERE t1.trip_id=t2.trip_id;''' % (self.table, self.table)
-        self.db.execute(cmd)
-
-        # Walk segment length, and distances from start of 400m buffer to end, using (i) the GPS trace, (ii) map-matching
-        cmd = '''UPDATE %s SET  walklength = ST_Distance(end_geom, park_geom),
-                                walkdist = ST_Length(lineswalk_geom),
-                                parkdist = ST_Length(lineslot_geom);''' % self.table
-        self.db.execute(cmd)
-
-        # Set distance ratio to be a minimum of one - if they found an 'illegal' shorter route, this is OK
-        cmd = '''UPDATE %s SET dist_ratio = GREATEST(matchdist / netwkdist, 1) WHERE netwkdist >0;''' % self.table
-        self.db.execute(cmd)
-
-        # Calculate the fraction of matched_line400 that lies within the 400m buffer
-        cmd = '''UPDATE %s SET frc_inbuffer = ST_Length(ST_Intersection(matched_line, ST_Buffer(end_geom, %s))) / matchdist WHERE matchdist>0;''' % (self.table, r)
-        self.db.execute(cmd)
+        # All the columns are calculated in one pass, so that each row (and its geometries) is only written once (see writeStageResults())
+        # Each nested subquery adds the columns that depend on the previous ones, in the order that they used to be calculated
 
         # Euclidean distance (m) between start and end of the line (entire trace, not just the 400m buffer). Null if we don't have the true start
         if 'start_good' in self.db.list_columns_in_table(self.table):
-            cmd = '''UPDATE %s SET start_end_dist = ST_Distance(start_geom, end_geom) WHERE start_good=True;''' % (self.table)
+            startEndSql = 'CASE WHEN start_good=True THEN ST_Distance(start_geom, end_geom) END'
         elif 'start_geom' in self.db.list_columns_in_table(self.table):
-            cmd = '''UPDATE %s SET start_end_dist = ST_Distance(start_geom, end_geom);''' % (self.table)
+            startEndSql = 'ST_Distance(start_geom, end_geom)'
         else: # nn_traces don't have start_geom
-            cmd = '''UPDATE %s SET start_end_dist = ST_Distance(ST_StartPoint(lines_geom), end_geom);''' % (self.table)
-        self.db.execute(cmd)
-
-        # Any evidence of cruising?
-        cmd = 'UPDATE %s SET cruise = False WHERE dist_ratio is not Null;' % self.table
-        self.db.execute(cmd)
-        cmd = '''UPDATE %s SET cruise = True WHERE (matchdist - netwkdist >5 OR ids_repeat>0)
-                     AND max_dist <= %s AND frc_inbuffer>%s;''' % (self.table, maxDistThres, bufferThresh)
-        self.db.execute(cmd)
-
-        cmd = 'UPDATE %s SET high_cruise = False WHERE dist_ratio is not Null;' % (self.table)
-        self.db.execute(cmd)
-        cmd = 'UPDATE %s SET high_cruise = True WHERE matchdist - netwkdist>200 AND cruise = True;' % (self.table)
-        self.db.execute(cmd)
-        #cmd = 'UPDATE %s SET ids_repeat = 0 WHERE high_cruise=False AND ids_repeat>0;'
-        #self.db.execute(cmd)
-
-        # Calculate cruising time, as excess travel / speed
-        cmd = '''UPDATE {} SET cruise_time =
-                    CASE WHEN high_cruise is True THEN GREATEST((matchdist - netwkdist) / (matchdist / (ST_M(ST_EndPoint(lbuff_geom)) - ST_M(ST_StartPoint(lbuff_geom)))),0)
-                    WHEN high_cruise is False THEN 0 ELSE Null END;'''.format(self.table)
-        self.db.execute(cmd)
+            startEndSql = 'ST_Distance(ST_StartPoint(lines_geom), end_geom)'
+
+        # For the other radii, max_dist is over the points from id_first for that radius to the parking point, and is calculated for all radii in one pass
+        # The map-matched line is for radius r, so the cruising flags use its excess distance with the max_dist and frc_inbuffer for each radius
+        if len(radii)>0:
+            radiiSql = ''', (SELECT %s FROM ST_DumpPoints(lines_geom) AS dp) AS mr''' % ', '.join(
+                    ['''MAX(CASE WHEN dp.path[1]>=id_first_%d AND dp.path[1]<=id_park
+                                 THEN ST_Distance(dp.geom, end_geom) END) AS max_dist_%d''' % (radius, radius) for radius in radii])
+            cruiseCols = ''.join([''', CASE WHEN (matchdist - netwkdist >%(excess)s OR ids_repeat>0) AND max_dist_%(radius)d <= %(maxDist)s AND frc_inbuffer_%(radius)d>%(bufferThresh)s THEN True
+                                       WHEN dist_ratio is not Null THEN False END AS cruise_%(radius)d''' % {'radius': radius,
+                                       'excess': cruiseExcessDist, 'maxDist': maxDistThres, 'bufferThresh': bufferThresh} for radius in radii])
+            highCruiseCols = ''.join([''', CASE WHEN matchdist - netwkdist>%(highExcess)s AND cruise_%(radius)d = True THEN True
+                                   WHEN dist_ratio is not Null THEN False END AS high_cruise_%(radius)d''' % {'radius': radius, 'highExcess': highCruiseExcessDist} for radius in radii])
+        else:
+            radiiSql, cruiseCols, highCruiseCols = '', '', ''
+
+        cmd = '''SELECT %(cols)s FROM
+            -- Calculate cruising time, as excess travel / speed
+            (SELECT b3.*, CASE WHEN high_cruise is True THEN GREATEST((matchdist - netwkdist) / (matchdist / (ST_M(ST_EndPoint(lbuff_geom)) - ST_M(ST_StartPoint(lbuff_geom)))),0)
+                               WHEN high_cruise is False THEN 0 ELSE Null END AS cruise_time FROM
+                (SELECT b2.*, CASE WHEN matchdist - netwkdist>%(highExcess)s AND cruise = True THEN True
+                                   WHEN dist_ratio is not Null THEN False END AS high_cruise%(highCruiseCols)s FROM
+                    -- Any evidence of cruising?
+                    (SELECT b1.*, CASE WHEN (matchdist - netwkdist >%(excess)s OR ids_repeat>0) AND max_dist <= %(maxDist)s AND frc_inbuffer>%(bufferThresh)s THEN True
+                                       WHEN dist_ratio is not Null THEN False END AS cruise%(cruiseCols)s FROM
+                        (SELECT m.*, %(radiiCols_mr)s
+                                -- Walk segment length, and distances from start of 400m buffer to end, using (i) the GPS trace, (ii) map-matching
+                                ST_Distance(end_geom, park_geom) AS walklength,
+                                ST_Length(%(lineswalk)s) AS walkdist,
+                                ST_Length(%(lineslot)s) AS parkdist,
+                                -- Set distance ratio to be a minimum of one - if they found an 'illegal' shorter route, this is OK
+                                CASE WHEN netwkdist>0 THEN GREATEST(matchdist / netwkdist, 1) END AS dist_ratio,
+                                -- Fraction of matched_line that lies within the 400m buffer
+                                CASE WHEN matchdist>0 THEN ST_Length(ST_Intersection(matched_line, ST_Buffer(end_geom, %(r)s))) / matchdist END AS frc_inbuffer,
+                                %(startEnd)s AS start_end_dist
+                            -- max distance from end point
+                            FROM (SELECT MAX(ST_Distance(dp.geom, end_geom)) AS max_dist FROM ST_DumpPoints(lbuff_geom) AS dp) AS m %(radiiSql)s
+                        ) AS b1) AS b2) AS b3) AS b4''' % {'cols': ', '.join([cc[0] for cc in cols]), 'r': r, 'startEnd': startEndSql,
+                   'excess': cruiseExcessDist, 'highExcess': highCruiseExcessDist, 'maxDist': maxDistThres, 'bufferThresh': bufferThresh,
+                   'radiiCols_mr': 'mr.*,' if len(radii)>0 else '', 'radiiSql': radiiSql, 'cruiseCols': cruiseCols, 'highCruiseCols': highCruiseCols,
+                   'lineswalk': self.lineSql('lineswalk_geom'), 'lineslot': self.lineSql('lineslot_geom')}
+        self.writeStageResults('otherdistances', cols, cmd)
 
     def addParkingInfo(self):
         """DISTANCE TO PARKING (meters, off-street) AND CURB,
@@ -801,150 +1922,748 @@ class traceTable():
         cols = [('bg', 'varchar'), ('end_clazz', 'int'),
                 ('near_lot_dist', 'real'), ('curb_dist','real')]
 
-        if 'bg' in self.db.list_columns_in_table(self.table):
+        if self.hasStageResults('parkinginfo', 'bg'):
             if self.forceUpdate:
-                dropTxt = ', '.join(['DROP COLUMN IF EXISTS '+cc[0] for cc in cols])
-                self.db.execute('ALTER TABLE %s %s;' % (self.table, dropTxt))
+                self.dropStageResults('parkinginfo', cols)
             else:
                 self.writeLog('Parking info already added. Skipping')
                 return
-        self.db.addColumns(cols, self.table, dropOld=True)
+        tables = self.db.list_tables()
 
         # End block group
+        # The block groups are split into small pieces, so that the spatial index only returns the few pieces near the end point
         self.writeLog('\tFinding end census block group')
-        cmd = '''UPDATE %s t1 SET bg = t2.bg FROM
-                    (SELECT c1.bg, trip_id FROM %s, %s_bgs c1 WHERE ST_Intersects(end_geom, geom)) AS t2
-                 WHERE t1.trip_id = t2.trip_id;''' % (self.table, self.table,self.region)
-        try:
-            self.db.execute(cmd)
-        except:
+        if self.region+'_bgs' in tables:
+            if self.region+'_bgs_subdivided' not in tables or self.forceUpdate:
+                self.db.execute('DROP TABLE IF EXISTS %s_bgs_subdivided;' % self.region)
+                self.db.execute('CREATE TABLE %s_bgs_subdivided AS SELECT bg, ST_Subdivide(geom, 256) AS geom FROM %s_bgs;' % (self.region, self.region))
+                self.db.create_indices(self.region+'_bgs_subdivided', geom='geom')
+                self.db.execute('ANALYZE %s_bgs_subdivided;' % self.region)
+            bgSql = '(SELECT c1.bg FROM %s_bgs_subdivided c1 WHERE ST_Intersects(end_geom, c1.geom) LIMIT 1)' % self.region
+        else:
             self.writeLog('\tCannot identify census block group. Perhaps the table is missing? Skipping.')
-
-        # OSM class of last street edge (e.g. is it a parking lot alley?)
-        cmd = '''UPDATE %s t1 SET end_clazz = clazz
-                    FROM %s WHERE edge_id_end=id;''' % (self.table, self.streets)
-        self.db.execute(cmd)
+            bgSql = 'Null'
 
         # Distance to closest off-street lot
+        # The lots and curbs are found with nearest neighbor (<->) searches of their spatial indexes, one trip at a time
         self.writeLog('\tFinding closest off-street lot to end point')
-        cmd = '''UPDATE %s t1 SET near_lot_dist = dist
-                 FROM (SELECT DISTINCT ON (pt.trip_id) pt.trip_id,
-                              ST_Distance(l.geom, pt.park_geom) AS dist
-                    FROM %s as pt, %s_off_street as l
-                    WHERE ST_DWithin(l.geom, pt.park_geom, 100)
-                    ORDER BY pt.trip_id, dist) AS t2
-                    WHERE t1.trip_id = t2.trip_id;''' % (self.table, self.table, self.region)
-        try:
-            self.db.execute(cmd)
-        except:
+        if self.region+'_off_street' in tables:
+            lotSql = '''(SELECT ST_Distance(l.geom, park_geom) AS dist FROM %s_off_street AS l
+                            WHERE ST_DWithin(l.geom, park_geom, 100) ORDER BY l.geom <-> park_geom LIMIT 1)''' % self.region
+        else:
             self.writeLog('\tCannot identify closest off-street parking lot. Perhaps the table is missing? Skipping.')
+            lotSql = 'Null'
 
         # Last known position - distance from curb ROW (negative if further from street centerline than curb ROW)
         # The ST_ClosestPoint() gets the distance from the centerline to the closest point on the curb to the end point
         self.writeLog('\tCalculating distance from curb')
-        cmd = '''WITH dists AS
-                    (SELECT DISTINCT ON (pt.trip_id) trip_id,
-                        ST_Distance(pt.park_geom, r.geom_way) as pt_centerline_dist,
-                        ST_Distance(pt.park_geom, c.geom) as pt_curb_dist,
-                        ST_Distance(ST_ClosestPoint(c.geom, pt.park_geom), r.geom_way) AS curb_centerline_dist
-                    FROM %s AS pt, %s AS r, %s_curblines AS c
-                  WHERE r.id = pt.edge_id_end AND ST_DWithin(c.geom, pt.park_geom, 200)
-                   ORDER BY pt.trip_id, pt_curb_dist)
-                UPDATE %s AS t1 SET curb_dist = curbdist FROM (
-                SELECT trip_id,
-                    CASE WHEN pt_centerline_dist < curb_centerline_dist THEN pt_curb_dist
-                    ELSE pt_curb_dist*-1 END AS curbdist
-                    FROM dists) AS dd
-                WHERE t1.trip_id=dd.trip_id;''' % (self.table, self.streets, self.region, self.table)
-        try:
-            self.db.execute(cmd)
-        except:
+        if self.region+'_curblines' in tables:
+            curbSql = '''(SELECT CASE WHEN pt_centerline_dist < curb_centerline_dist THEN pt_curb_dist
+                                      ELSE pt_curb_dist*-1 END FROM
+                            (SELECT ST_Distance(park_geom, r.geom_way) as pt_centerline_dist,
+                                    ST_Distance(park_geom, c.geom) as pt_curb_dist,
+                                    ST_Distance(ST_ClosestPoint(c.geom, park_geom), r.geom_way) AS curb_centerline_dist
+                             FROM %s AS r, %s_curblines AS c
+                             WHERE r.id = edge_id_end AND ST_DWithin(c.geom, park_geom, 200)
+                             ORDER BY c.geom <-> park_geom LIMIT 1) AS dists)''' % (self.streets, self.region)
+        else:
             self.writeLog('\tCannot calculate distance from curb. Perhaps the table is missing? Skipping.')
+            curbSql = 'Null'
+
+        # OSM class of last street edge (e.g. is it a parking lot alley?)
+        cmd = '''SELECT %s AS bg, (SELECT clazz FROM %s WHERE id=edge_id_end) AS end_clazz,
+                        %s AS near_lot_dist, %s AS curb_dist''' % (bgSql, self.streets, lotSql, curbSql)
+        self.writeStageResults('parkinginfo', cols, cmd, parallel=True)
 
     def defineUsableTrips(self):
         """Set use_trip to be False where the trip ends on a freeway, or when match_score<qualityCutoff"""
-
-        self.db.addColumns([('use_trip','boolean'),('end_clazz','int')], self.table, skipIfExists=True)
-        self.db.execute('''UPDATE {} SET end_clazz = clazz FROM {} WHERE id = edge_id_end'''.format(self.table, self.streets))
-        self.db.execute('UPDATE %s SET use_trip=False;' % self.table)
-        self.db.execute('''UPDATE %s SET use_trip=True
-                             WHERE match_score>%s AND end_clazz!=11 AND pingtime_mean<=30 AND pingtime_max<=60;''' % (self.table, qualityCutoff))
+        # with narrowTables, end_clazz is already in the parkinginfo table
+        cols = [('use_trip','boolean')] if narrowTables else [('use_trip','boolean'),('end_clazz','int')]
+        cmd = '''SELECT %s FROM
+                    (SELECT COALESCE(match_score>%s AND end_clazz!=11 AND pingtime_mean<=30 AND pingtime_max<=60, False) AS use_trip, end_clazz FROM
+                        (SELECT (SELECT clazz FROM %s WHERE id = edge_id_end) AS end_clazz) AS c) AS u''' % (
+                    ', '.join([cc[0] for cc in cols]), qualityCutoff, self.streets)
+        self.writeStageResults('usabletrips', cols, cmd)
+
+    def getClassificationFeatures(self, forceUpdate=False):
+        """Per-trip features that the cruising classification in addOtherDistances() and defineUsableTrips() is based on
+        These come from the truncation, map matching and network distance stages (and max_dist and frc_inbuffer,
+        which don't depend on the classification parameters), so runall() must have been run first
+        They are fetched once and kept, so that sweepClassification() doesn't need to query the database again"""
+        if self.classificationFeatures is None or forceUpdate:
+            cmd = '''SELECT trip_id, matchdist, netwkdist, ids_repeat, max_dist, frc_inbuffer, match_score, end_clazz, pingtime_mean, pingtime_max,
+                              ST_M(ST_EndPoint(lbuff_geom)) - ST_M(ST_StartPoint(lbuff_geom)) AS duration
+                       FROM %s;''' % self.resultsTn()
+            self.classificationFeatures = self.db.execfetchDf(cmd).set_index('trip_id')
+        return self.classificationFeatures
+
+    def sweepClassification(self, grid):
+        """Evaluate the cruising classification for every combination of parameter values, without rerunning any stage
+        grid: dict of parameter name: list of values. The parameters are maxDistThres, bufferThresh, qualityCutoff,
+              cruiseExcessDist and highCruiseExcessDist. Those that are not given are kept at their current values
+        Returns a dataframe with one row per combination, giving the number of usable trips with a cruising classification,
+        and the number and fraction that are cruising and high cruising, and the mean cruising time (seconds)
+        The classification is the same as addOtherDistances() and defineUsableTrips(), in vectorized form
+        Parameters that change the truncation or map matching (e.g. r and wSpeed) need the stages to be rerun instead"""
+        params = OrderedDict([('maxDistThres', maxDistThres), ('bufferThresh', bufferThresh), ('qualityCutoff', qualityCutoff),
+                              ('cruiseExcessDist', cruiseExcessDist), ('highCruiseExcessDist', highCruiseExcessDist)])
+        for param in grid:
+            if param not in params:
+                raise Exception('Cannot sweep over parameter %s. Choose from %s' % (param, ', '.join(params)))
+        values = OrderedDict((param, list(np.atleast_1d(grid.get(param, default)))) for param, default in params.items())
+
+        starttime = time.time()
+        feats = self.getClassificationFeatures()
+        excess = (feats.matchdist - feats.netwkdist).values
+        repeat = (feats.ids_repeat>0).values
+        hasRatio = (feats.netwkdist>0).values & feats.matchdist.notnull().values  # i.e. dist_ratio is not Null
+        goodTrace = (feats.end_clazz.notnull() & (feats.end_clazz!=11) & (feats.pingtime_mean<=30) & (feats.pingtime_max<=60)).values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cruiseTime = np.fmax(excess / (feats.matchdist / feats.duration).values, 0)
+
+        # each condition only depends on one parameter, so evaluate it once for each value
+        maxDistOk = {vv: (feats.max_dist<=vv).values for vv in values['maxDistThres']}
+        bufferOk = {vv: (feats.frc_inbuffer>vv).values for vv in values['bufferThresh']}
+        usable = {vv: goodTrace & (feats.match_score>vv).values for vv in values['qualityCutoff']}
+        excessOk = {vv: (excess>vv) | repeat for vv in values['cruiseExcessDist']}
+        highExcessOk = {vv: excess>vv for vv in values['highCruiseExcessDist']}
+
+        rows = []
+        for combo in itertools.product(*values.values()):
+            md, bt, qc, ce, hce = combo
+            cruise = excessOk[ce] & maxDistOk[md] & bufferOk[bt] & usable[qc]
+            highCruise = cruise & highExcessOk[hce]
+            nTrips = (usable[qc] & (hasRatio | cruise)).sum()  # trips where cruise is not Null
+            nCruise, nHighCruise = cruise.sum(), highCruise.sum()
+            meanCruiseTime = np.nan if nTrips==0 else np.nansum(cruiseTime[highCruise]) / float((usable[qc] & (hasRatio | highCruise)).sum())
+            rows.append(list(combo)+[nTrips, nCruise, nCruise/float(max(nTrips,1)), nHighCruise, nHighCruise/float(max(nTrips,1)), meanCruiseTime])
+        result = pd.DataFrame(rows, columns=list(values.keys())+['ntrips', 'ncruise', 'frc_cruise', 'nhigh_cruise', 'frc_high_cruise', 'mean_cruise_time'])
+        self.writeLog('Evaluated %d parameter combinations for %d trips in %.1f seconds' % (len(result), len(feats), time.time()-starttime))
+        return result
+
+    def stageGraph(self):
+        """The stages of the analysis, in the order that runall() runs them
+        Returns an OrderedDict of stage name: (function, upstream stages, parameters)
+        The upstream stages are those whose outputs the stage uses,
+        and the parameters are the key parameters and input tables that affect its results"""
+        streetsVersion = self.getStreetsVersion()  # changes if the streets or turn restrictions are edited
+        try:
+            coeffVersion = hashlib.md5(open(coeffFn, 'rb').read()).hexdigest()
+        except:
+            coeffVersion = None
+        mapMatch = self.mapMatchinSerial if self.nCores is None else self.mapMatchinParallel
+        radii = {'bufferRadii': extraRadii()} if len(extraRadii())>0 else {}  # only included when used, so that existing fingerprints are unchanged
+        radiiStage = ['bufferradii'] if len(extraRadii())>0 else []
+        rejection = {'earlyRejection': True, 'qualityCutoff': qualityCutoff} if earlyRejection else {}
+        routing = {'routingMethod': routingMethod, 'routingMaxCost': routingMaxCost} if routingMethod=='inprocess' else {}  # pgRouting gives the same distances with or without the envelope
+        thinning = {'downsampleSpacing': downsampleSpacing, 'downsampleSecs': downsampleSecs, 'downsampleTurnAngle': downsampleTurnAngle}
+        thinned = thinning if downsampleSpacing is not None or downsampleSecs is not None else {}
+        return OrderedDict([
+            ('errantpings',    (self.dropErrantPings, [], {})),
+            ('lotpolygons',    (self.createLotPolygons, [], {'streets': self.streets, 'offstreet': self.offstreetName})),
+            # the tails only speed up truncateAllLines(), which gives the same results without them, so pretruncate is not upstream of truncate
+            ('pretruncate',    (self.createTraceTails, ['errantpings'], dict({'r': r, 'rollSecs': rollSecs, 'maxDistThres': maxDistThres}, **radii))),
+            ('truncate',       (self.truncateAllLines, ['errantpings', 'lotpolygons'], {'r': r, 'rollSecs': rollSecs, 'wSpeed': wSpeed})),
+            # truncate calculates the metrics for the additional radii too, but they only feed addOtherDistances(),
+            # so bufferRadii is left out of its fingerprint, and bufferradii fills them in if it changes
+            ('bufferradii',    (self.calcBufferRadii, ['truncate'], dict({'r': r, 'rollSecs': rollSecs, 'wSpeed': wSpeed}, **radii))),
+            ('downsample',     (self.downsampleTraces, ['truncate'], thinning)),
+            ('mapmatch',       (mapMatch, ['truncate'], dict({'streets': self.streets, 'streetsVersion': streetsVersion, 'coefficients': coeffVersion}, **dict(rejection, **thinned)))),
+            ('supplementary',  (self.addMapMatchedSupplementaryData, ['mapmatch'], {'coefficients': coeffVersion})),
+            ('timestamps',     (self.addTimeStamps, ['truncate'], {})),
+            ('netwkdist',      (self.calcAllNetworkDistances, ['supplementary'], dict({'streetsVersion': streetsVersion}, **dict(rejection, **routing)))),
+            ('otherdistances', (self.addOtherDistances, ['truncate', 'supplementary', 'netwkdist']+radiiStage, dict({'r': r, 'maxDistThres': maxDistThres, 'bufferThresh': bufferThresh,
+                                                                                                     'cruiseExcessDist': cruiseExcessDist, 'highCruiseExcessDist': highCruiseExcessDist}, **radii))),
+            ('parkinginfo',    (self.addParkingInfo, ['truncate', 'supplementary'], {'r': r, 'region': self.region, 'streets': self.streets})),
+            ('usabletrips',    (self.defineUsableTrips, ['supplementary'], {'streets': self.streets, 'qualityCutoff': qualityCutoff})),
+            ])
+
+    def stageFingerprint(self, stage):
+        """The fingerprint recorded when stage last finished, or when it started if it was interrupted. None if there isn't one"""
+        self.stageStatus(stage)  # creates the table if needed
+        result = self.db.execfetch("SELECT fingerprint FROM %s_stages WHERE stage='%s';" % (self.table, stage))
+        return None if len(result)==0 else result[0][0]
+
+    def recordFingerprint(self, stage, fingerprint):
+        self.db.execute("""INSERT INTO %s_stages (stage, status, updated, fingerprint) VALUES ('%s', 'done', now(), '%s')
+                           ON CONFLICT (stage) DO UPDATE SET status='done', updated=now(), fingerprint=EXCLUDED.fingerprint;""" % (
+                           self.table, stage, fingerprint))
+
+    def stageFingerprints(self, stages=None):
+        """Returns an OrderedDict with the fingerprint of each stage in stageGraph()
+        This is a hash of the stage's parameters and of the fingerprints of its upstream stages"""
+        stages = self.stageGraph() if stages is None else stages
+        fingerprints = OrderedDict()
+        for stage, (fn, upstream, params) in stages.items():
+            fingerprints[stage] = hashlib.md5(json.dumps([params]+[fingerprints[uu] for uu in upstream], sort_keys=True).encode()).hexdigest()
+        return fingerprints
 
     def runall(self):
-        """This is the sequence of functions that the analysis runs through"""
-
-        self.dropErrantPings()
-        self.createLotPolygons()
-        self.truncateAllLines()
-        if self.nCores is None:
-            self.mapMatchinSerial()
-        else:
-            self.mapMatchinParallel()
-        self.addMapMatchedSupplementaryData()
-        self.addTimeStamps()
-        self.calcAllNetworkDistances()
-        self.addOtherDistances()
-        self.addParkingInfo()
-        self.defineUsableTrips()
-
-def apply_multiprocessing(input_function, input_list, pool_size=5):
-    """Handles multiprocessing pools gracefully, allows interrupts
-    https://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool/1408476#1408476"""
-    pool = multiprocessing.Pool(processes=pool_size, maxtasksperchild=10)
+        """This is the sequence of functions that the analysis runs through
+        Each stage records a fingerprint of its parameters and of the fingerprints of its upstream stages (see stageGraph())
+        If forceUpdate is False, a stage that has already been run is only recalculated if its fingerprint has changed,
+        i.e. if one of its parameters, or something upstream of it, has changed. Other completed stages are skipped"""
+        forceUpdate = self.forceUpdate
+        stages = self.stageGraph()
+        fingerprints = self.stageFingerprints(stages)
+        for stage, (fn, upstream, params) in stages.items():
+            previous = self.stageFingerprint(stage)
+            changed = previous is not None and previous!=fingerprints[stage]
+            if changed and not forceUpdate:
+                self.writeLog('Parameters or inputs of stage %s have changed. Recalculating it' % stage)
+            self.forceUpdate = forceUpdate or changed
+            self.currentFingerprint = fingerprints[stage]
+            if narrowTables and (stage not in narrowStages or stage=='truncate'):  # the results view would stop the stage from dropping columns of the trace table
+                self.db.execute('DROP VIEW IF EXISTS %s;' % self.resultsTn())
+            try:
+                fn()
+            finally:
+                self.forceUpdate, self.currentFingerprint = forceUpdate, None
+            self.recordFingerprint(stage, fingerprints[stage])
+        if narrowTables:
+            self.createResultsView()
+
+def extraRadii(radii=None):
+    """The additional buffer radii (as integers), excluding r itself. Defaults to bufferRadii"""
+    radii = bufferRadii if radii is None else radii
+    return sorted(set([int(rr) for rr in radii]) - set([int(r)]))
+
+# the sub-lines of lines_geom made by truncateAllLines(), and the range of point indexes in each (None means the end of the trace)
+subLines = OrderedDict([('lbuff_geom', ('id_first', 'id_park')), ('lineslot_geom', ('id_park', 'id_walk')),
+                        ('lineswalk_geom', ('id_walk', None)), ('linesall_geom', ('id_first', None))])
+lazyLines = ['lineslot_geom', 'lineswalk_geom', 'linesall_geom']  # not stored if lazyGeometries is True. lbuff_geom is map matched and indexed, so it is always stored
+slicedTripsSql = 'id_first<=id_park AND id_park<=id_walk AND id_walk<=ST_NPoints(lines_geom)'  # the trips that have sub-lines
+
+def sliceFilterSql(idFrom, idTo=None):
+    """Condition on the points of lines_geom (dumped as dp) that are in the range of point indexes idFrom to idTo"""
+    return 'dp.path[1]>=%s' % idFrom + ('' if idTo is None else ' AND dp.path[1]<=%s' % idTo)
+
+bufferMetricNames = ['id_first', 'id_firstx2', 'maxspeed', 'speed', 'donutspeed', 'pingtime_meanbuf', 'pingtime_maxbuf', 'npingsbuf', 'npingsdonut', 'frc_inbuffer']
+
+def radiusColumns(radii):
+    """Names of the columns calculated by bufferMetrics() for each radius, in order"""
+    return [cc+'_%d' % radius for radius in radii for cc in bufferMetricNames]
+
+def bufferMetrics(pointsDf, radius, idWalk, idPark):
+    """Metrics for the portion of each trace within radius (meters) of the end point, and for the donut out to twice the radius
+    These are calculated in the same way as for radius r in truncateLines()
+    The exception is frc_inbuffer. For radius r, this is the fraction of the map-matched line within the buffer (see addOtherDistances()),
+    but the match is only for radius r. So here, it is the fraction of the GPS trace from id_first (for this radius) to id_park
+    that is within the buffer, i.e. of the distance between consecutive pings that are both within radius of the end point
+    pointsDf: the pings, with trip_id, ptid, disttoend, distdelta, speed and timedelta
+    idWalk, idPark: series of id_walk and id_park, indexed by trip_id
+    Returns a dataframe indexed by trip_id, with the columns in radiusColumns()"""
+    trips = idWalk.index
+    idFirst = np.fmax(pointsDf[pointsDf.disttoend<=radius].groupby('trip_id').ptid.min().reindex(trips)-1, 1)
+    idFirstx2 = np.fmax(pointsDf[pointsDf.disttoend<=radius*2].groupby('trip_id').ptid.min().reindex(trips)-1, 1)
+    first, firstx2, walk, park = [pointsDf.trip_id.map(ss) for ss in [idFirst, idFirstx2, idWalk, idPark]]
+
+    bufMask = (pointsDf.ptid>first) & (pointsDf.ptid<=walk)
+    donutMask = (pointsDf.ptid>firstx2) & (pointsDf.ptid<=first+1)
+    lineMask = (pointsDf.ptid>first) & (pointsDf.ptid<=park)  # distdelta is the distance from the previous ping, so this is the line from id_first to id_park
+    insideMask = lineMask & (pointsDf.disttoend<=radius) & (pointsDf.groupby('trip_id').disttoend.shift()<=radius)
+    lineLength = pointsDf.distdelta.where(lineMask).groupby(pointsDf.trip_id).sum()
+    insideLength = pointsDf.distdelta.where(insideMask).groupby(pointsDf.trip_id).sum()
+    bufGrouped = pointsDf[bufMask].groupby('trip_id')
+    metricsDf = pd.DataFrame({'id_first': idFirst, 'id_firstx2': idFirstx2,
+                              'maxspeed': bufGrouped.speed.max(), 'speed': bufGrouped.speed.mean(),
+                              'donutspeed': pointsDf[donutMask].groupby('trip_id').speed.mean(),
+                              'pingtime_meanbuf': bufGrouped.timedelta.mean(), 'pingtime_maxbuf': bufGrouped.timedelta.max(),
+                              'npingsbuf': bufMask.groupby(pointsDf.trip_id).sum(), 'npingsdonut': donutMask.groupby(pointsDf.trip_id).sum(),
+                              'frc_inbuffer': (insideLength/lineLength.where(lineLength>0)).reindex(trips)},
+                             index=trips)[bufferMetricNames]
+    metricsDf.columns = radiusColumns([radius])
+    return metricsDf
+
+workerDb = None             # persistent database connection for this (worker) process. See getWorkerDb()
+preparedStatements = set()  # names of the statements that have been prepared on workerDb
+
+def initWorker(pgLogin):
+    """Pool initializer: open one database connection per worker process, which is reused for its lifetime"""
+    global workerDb
+    workerDb = None  # don't share a connection inherited from the parent process
+    preparedStatements.clear()
+    getWorkerDb(pgLogin)
+
+def getWorkerDb(pgLogin):
+    """Returns the persistent database connection for this process, opening it if needed"""
+    global workerDb
+    if workerDb is None:
+        workerDb = mmt.dbConnection(pgLogin=pgLogin, verbose=False)
+    return workerDb
+
+def resetWorkerDb():
+    """Close and drop the persistent connection (e.g. if it is broken), so that a new one is opened next time"""
+    global workerDb
+    if workerDb is not None and hasattr(workerDb, 'connection'):
+        try:
+            workerDb.connection.close()
+        except Exception:
+            pass  # already closed
+    workerDb = None
+    preparedStatements.clear()
+
+def rollbackWorkerDb():
+    """Roll back the aborted transaction after a failed query (e.g. path not found), as in executeWithRollback()
+    The connection and its prepared statements are kept. If the rollback fails, the connection is broken, so it is dropped"""
+    if workerDb is None:
+        return
+    try:
+        if hasattr(workerDb, 'connection'):
+            workerDb.connection.rollback()
+    except Exception:
+        resetWorkerDb()
+
+def prepareStatement(db, name, argTypes, sql):
+    """Prepare sql as a server-side statement on db, unless this has already been done
+    It can then be run with EXECUTE name(args), without being parsed and planned again for each trip"""
+    if name not in preparedStatements:
+        db.execute('PREPARE %s (%s) AS %s;' % (name, argTypes, sql))
+        preparedStatements.add(name)
+
+def sqlValue(value):
+    """Formats a python or numpy value as a SQL literal for resultsWriter. NaN, None and the string 'Null' are Null"""
+    if value is None or (isinstance(value, str) and value=='Null'):
+        return 'Null'
+    if isinstance(value, str):
+        return "'%s'" % value.replace("'", "''")
+    try:
+        if np.isnan(value):
+            return 'Null'
+        if np.isinf(value):
+            return "'Infinity'" if value>0 else "'-Infinity'"
+    except TypeError:
+        pass
+    return str(value)
+
+def progressSql(traceTn, stage, ids):
+    """SQL to record that stage has completed the trips in ids, in <traceTn>_progress (see traceTable.startStage())
+    This is appended to the SQL that writes the results, so that both happen in the same transaction"""
+    if len(ids)==0:
+        return ''
+    return "INSERT INTO %s_progress (stage, trip_id) VALUES %s ON CONFLICT DO NOTHING;" % (
+                traceTn, ', '.join(["('%s', %d)" % (stage, id) for id in ids]))
+
+class resultsWriter():
+    def __init__(self, db, tn, columns, flushsize=5000, append=False, progress=None):
+        """Writes rows to a postgres table as they are calculated, so that the results never have to be held in memory
+        db: pgMapMatch dbConnection
+        tn: name of the results table. Any existing table of this name is replaced, unless append is True
+        columns: list of (column name, postgres type) tuples, in the order of each row. The first column is the primary key
+        flushsize: number of rows to hold before inserting them
+        append: add to the existing results table (if any), e.g. when resuming a stage
+        progress: (trace table, stage) tuple. If given, the ids in the first column are recorded as completed
+                  in the same statement as the rows are inserted (see progressSql())
+        The table is logged, like the progress table, so that the results survive a crash as well as the record of them"""
+        self.db, self.tn, self.flushsize, self.progress = db, tn, flushsize, progress
+        self.columns = [cc[0] for cc in columns]
+        self.rows = []
+        self.nRows = 0
+        if not append:
+            self.db.execute('DROP TABLE IF EXISTS %s;' % self.tn)
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s (%s, PRIMARY KEY (%s));' % (
+                            self.tn, ', '.join(['%s %s' % cc for cc in columns]), self.columns[0]))
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows)>=self.flushsize:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows)==0:
+            return
+        values = ',\n'.join(['(%s)' % ', '.join([sqlValue(vv) for vv in row]) for row in self.rows])
+        cmd = 'INSERT INTO %s (%s) VALUES %s ON CONFLICT DO NOTHING;' % (self.tn, ', '.join(self.columns), values)
+        if self.progress is not None:
+            cmd += progressSql(self.progress[0], self.progress[1], [row[0] for row in self.rows])
+        self.db.execute(cmd)
+        self.nRows += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        """Writes any remaining rows. Returns the number of rows written"""
+        self.flush()
+        return self.nRows
+
+def apply_to_chunk(input_function, chunk):
+    """Calls input_function on each set of arguments in chunk, so that stream_multiprocessing() can submit several inputs per task
+    Returns a list of results, with -1 for any input that failed"""
+    results = []
+    for args in chunk:
+        try:
+            results.append(input_function(*args))
+        except Exception as e:
+            print(e)
+            results.append(-1)
+    return results
+
+def stream_multiprocessing(input_function, input_list, pool_size=5, chunksize=1, maxInFlight=None, maxtasksperchild=10, pgLogin=None):
+    """Generator version of apply_multiprocessing() that yields (index, result) tuples as each task finishes
+    Unlike apply_multiprocessing(), input_list can be a generator, only maxInFlight tasks are submitted at a time,
+    and results are not kept once they have been yielded, so memory use does not grow with the number of inputs
+    chunksize: number of inputs per task, to reduce the overhead of many small tasks
+    maxInFlight: maximum number of tasks that have been submitted but not yet consumed. Defaults to 4 per process
+    maxtasksperchild, pgLogin: as for apply_multiprocessing()
+    Failed inputs have a result of -1"""
+    if maxInFlight is None:
+        maxInFlight = pool_size*4
+    if pgLogin is None:
+        pool = multiprocessing.Pool(processes=pool_size, maxtasksperchild=maxtasksperchild)
+    else:
+        pool = multiprocessing.Pool(processes=pool_size, maxtasksperchild=maxtasksperchild, initializer=initWorker, initargs=(pgLogin,))
+    done = queue.Queue()  # the callbacks put (index of first input, number of inputs, results) here
+
+    def submit(firstIdx, chunk):
+        pool.apply_async(apply_to_chunk, (input_function, chunk),
+                         callback=lambda rr: done.put((firstIdx, len(chunk), rr)),
+                         error_callback=lambda e: done.put((firstIdx, len(chunk), e)))
+
+    def collect():
+        while True:
+            try:  # the timeout means that KeyboardInterrupt is not blocked while we wait
+                firstIdx, nInputs, results = done.get(timeout=1)
+                break
+            except queue.Empty:
+                continue
+        if isinstance(results, Exception):
+            print(results)
+            results = [-1]*nInputs
+        return [(firstIdx+jj, rr) for jj, rr in enumerate(results)]
 
     try:
-        jobs = {}
+        inFlight, chunk, firstIdx = 0, [], 0
         for ii, value in enumerate(input_list):  # enumeration is a way to deal with unhashable types
             args = value if isinstance(value,list) or isinstance(value, tuple) else [value]
-            jobs[ii] = pool.apply_async(input_function, args)
-
-        results = {}
-        for value, result in jobs.items():
-            try:
-                results[value] = result.get()
-            except KeyboardInterrupt:
-                print ('Interrupted by user')
-                pool.terminate()
-                break
-            except Exception as e:
-                print(e)
-                results[value] = -1
-        return results
-    except Exception:
+            chunk.append(args)
+            if len(chunk)<chunksize:
+                continue
+            submit(firstIdx, chunk)
+            inFlight += 1
+            chunk, firstIdx = [], ii+1
+            while inFlight>=maxInFlight:
+                for result in collect():
+                    yield result
+                inFlight -= 1
+        if len(chunk)>0:
+            submit(firstIdx, chunk)
+            inFlight += 1
+        while inFlight>0:
+            for result in collect():
+                yield result
+            inFlight -= 1
+    except KeyboardInterrupt:
+        print ('Interrupted by user')
+        pool.terminate()
+        raise  # so that the caller does not carry on as if all the inputs had been processed
+    except GeneratorExit:  # the caller stopped early, so don't wait for the remaining tasks
+        pool.terminate()
         raise
     finally:
         pool.close()
         pool.join()
 
-def mapMatch_wrapper(pingDict, streetsTn, traceTn, schema='public'):
-    """Wrapper for mapmatcher that avoids the problem with pickling objects in parallel"""
+def apply_multiprocessing(input_function, input_list, pool_size=5, maxtasksperchild=10, pgLogin=None):
+    """Handles multiprocessing pools gracefully, allows interrupts
+    https://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool/1408476#1408476
+    maxtasksperchild: workers are replaced after this many tasks. Use None to keep them (and their connections) for the whole pool
+    pgLogin: if given, each worker opens a persistent database connection when it starts (see getWorkerDb())
+    Returns a dict of results, with -1 for failed inputs. For large numbers of inputs, use stream_multiprocessing() instead"""
+    return dict(sorted(stream_multiprocessing(input_function, input_list, pool_size, maxtasksperchild=maxtasksperchild, pgLogin=pgLogin)))
+
+class mapMatchTimeout(Exception):
+    """Raised when a trace takes longer than its time limit to map match"""
+    pass
+
+def isTimeout(e):
+    """True if exception e is from a trace that took too long, either in python or in a postgres query"""
+    return isinstance(e, mapMatchTimeout) or 'statement timeout' in str(e)
+
+def setStatementTimeout(db, timeout):
+    """Cancel any query on this connection that takes longer than timeout seconds
+    matchTraceWithTimeout() can't interrupt a query while it is running in postgres, so this covers that part"""
+    db.execute('SET statement_timeout = %d;' % int(timeout*1000))
+
+def matchTraceWithTimeout(mapMatcher, id, timeout):
+    """Calls mapMatcher.matchPostgresTrace(id), raising mapMatchTimeout if it takes longer than timeout seconds
+    This uses SIGALRM where it exists. On Windows, a timer thread interrupts the main thread instead"""
+    if timeout is None:
+        return mapMatcher.matchPostgresTrace(id)
+    if hasattr(signal, 'SIGALRM'):
+        def onTimeout(signum, frame):
+            raise mapMatchTimeout('trace %s took longer than %d seconds' % (id, timeout))
+        previous = signal.signal(signal.SIGALRM, onTimeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return mapMatcher.matchPostgresTrace(id)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    timedOut = threading.Event()
+    def onTimeout():
+        timedOut.set()
+        _thread.interrupt_main()
+    timer = threading.Timer(timeout, onTimeout)
+    timer.start()
+    try:
+        return mapMatcher.matchPostgresTrace(id)
+    except KeyboardInterrupt:
+        if timedOut.is_set():
+            raise mapMatchTimeout('trace %s took longer than %d seconds' % (id, timeout))
+        raise
+    finally:
+        timer.cancel()
+
+def executeWithRollback(db, cmd):
+    """Execute cmd, rolling back first if the connection is in an aborted transaction (e.g. after a failed query)"""
+    try:
+        db.execute(cmd)
+    except Exception:
+        if hasattr(db, 'connection'):
+            db.connection.rollback()
+        db.execute(cmd)
+
+def quarantineTrace(db, traceTn, id, npings, seconds, timeout):
+    """Record a trace that timed out in <traceTn>_mmquarantine, so that it can be retried at the end of the stage"""
+    cmd = '''INSERT INTO %s_mmquarantine AS q (trip_id, npings, seconds, timeout, attempts, resolved) VALUES (%d, %d, %.3f, %.3f, 1, False)
+                  ON CONFLICT (trip_id) DO UPDATE SET seconds=EXCLUDED.seconds, timeout=EXCLUDED.timeout, attempts=q.attempts+1;''' % (
+                    traceTn, id, npings, seconds, timeout)
+    executeWithRollback(db, cmd)
+
+def recordFailure(db, traceTn, trips, error, seconds):
+    """Add traces that failed to map match to the failure ledger, <traceTn>_mmfailures, or increment their number of attempts
+    trips: list of (trip_id, npings) tuples"""
+    if len(trips)==0:
+        return
+    values = ', '.join(['(%d, %d, %s, 1, %s, False)' % (id, npings, sqlValue(error[:1000]), sqlValue(seconds)) for id, npings in trips])
+    cmd = '''INSERT INTO %s_mmfailures AS f (trip_id, npings, error, attempts, seconds, resolved) VALUES %s
+             ON CONFLICT (trip_id) DO UPDATE SET error=EXCLUDED.error, seconds=EXCLUDED.seconds, attempts=f.attempts+1, resolved=False;''' % (
+                traceTn, values)
+    executeWithRollback(db, cmd)
+
+def resolvedSql(traceTn, resolved):
+    """SQL to record that traces that were quarantined or failed have now been matched
+    resolved: list of (trip_id, seconds) tuples. See flushMatches()"""
+    return ''.join(['UPDATE %s_%s SET resolved=True, attempts=attempts+1, seconds=%.3f WHERE trip_id=%d;' % (traceTn, ledger, seconds, id)
+                    for id, seconds in resolved for ledger in ['mmquarantine', 'mmfailures']])
+
+matchedCols = ['matched_line', 'lbuff_geom_cleaned', 'edge_ids', 'match_score']  # the columns written by mapMatcher.writeMatchToPostgres()
+# the stages that can write to narrow tables (see narrowTables). truncate also writes the sub-lines of each trace to the trace table,
+# and map matching is not included, because the map matcher reads the trace from and writes the match to the trace table
+narrowStages = ['truncate', 'timestamps', 'netwkdist', 'otherdistances', 'parkinginfo', 'usabletrips']
+
+def matchGeomName(db, traceTn):
+    """The trace that is map matched: lbuff_geom_thin if the traces have been downsampled (see traceTable.downsampleTraces()), otherwise lbuff_geom"""
+    return 'lbuff_geom_thin' if 'lbuff_geom_thin' in db.list_columns_in_table(traceTn) else 'lbuff_geom'
+
+def downsampleSql(table, spacing=None, secs=None, turnAngle=30, minTurnDist=5):
+    """SQL to thin lbuff_geom in table to lbuff_geom_thin
+    A ping is kept if the distance along the trace passes a multiple of spacing (meters), or the time since the start of the trace
+    passes a multiple of secs, at that ping. The first and last ping are always kept, as are turns of more than turnAngle degrees
+    Turns are only counted where both segments are at least minTurnDist meters long, so that GPS jitter when stopped is not a turn"""
+    keep = ['npts<=3', 'ptid=1', 'ptid=npts', 'LEAST(turn, 360-turn)>%s' % turnAngle]
+    if spacing is not None:
+        keep.append('floor(cumdist/%s) > floor(prevdist/%s)' % (spacing, spacing))
+    if secs is not None:
+        keep.append('floor(elapsed/%s) > floor(prevelapsed/%s)' % (secs, secs))
+    return '''WITH pts AS (
+                SELECT trip_id, (dp).path[1] AS ptid, (dp).geom AS geom, ST_NPoints(lbuff_geom) AS npts
+                FROM (SELECT trip_id, lbuff_geom, ST_DumpPoints(lbuff_geom) AS dp FROM %(table)s) AS t),
+             segs AS (
+                SELECT *, lag(geom) OVER w AS prevgeom, lead(geom) OVER w AS nextgeom, ST_M(geom) - first_value(ST_M(geom)) OVER w AS elapsed
+                FROM pts WINDOW w AS (PARTITION BY trip_id ORDER BY ptid)),
+             cum AS (
+                SELECT *, SUM(COALESCE(ST_Distance(prevgeom, geom), 0)) OVER w AS cumdist,
+                       CASE WHEN ST_Distance(prevgeom, geom)>=%(mindist)s AND ST_Distance(geom, nextgeom)>=%(mindist)s
+                            THEN abs(degrees(ST_Azimuth(geom, nextgeom) - ST_Azimuth(prevgeom, geom))) END AS turn
+                FROM segs WINDOW w AS (PARTITION BY trip_id ORDER BY ptid)),
+             flags AS (
+                SELECT *, lag(cumdist) OVER w AS prevdist, lag(elapsed) OVER w AS prevelapsed
+                FROM cum WINDOW w AS (PARTITION BY trip_id ORDER BY ptid))
+             UPDATE %(table)s t SET lbuff_geom_thin = thin.geom FROM
+                (SELECT trip_id, ST_MakeLine(geom ORDER BY ptid) AS geom FROM flags
+                 WHERE %(keep)s
+                 GROUP BY trip_id) AS thin
+             WHERE t.trip_id=thin.trip_id;''' % {'table': table, 'mindist': minTurnDist, 'keep': ' OR '.join(keep)}
+
+def createMatchStaging(db, traceTn, ids):
+    """Copy the traces in ids to an unlogged staging table for this process, with empty map matching columns
+    The mapmatcher reads from and writes to this table, rather than the trace table, so that
+    the parallel workers don't each send one UPDATE per trace to the (large, logged) trace table. See flushMatches()
+    If the traces have been downsampled, the thinned trace is copied as lbuff_geom (see matchGeomName())
+    Returns the name of the staging table"""
+    stagingTn = '%s_mmstaging_%d' % (traceTn, os.getpid())
+    db.execute('DROP TABLE IF EXISTS %s;' % stagingTn)
+    db.execute('''CREATE UNLOGGED TABLE %s AS
+                    SELECT trip_id, %s AS lbuff_geom, %s FROM %s WHERE trip_id IN (%s);''' % (
+                    stagingTn, matchGeomName(db, traceTn), ', '.join(matchedCols), traceTn, ','.join([str(id) for id in ids])))
+    db.execute('ALTER TABLE %s ADD PRIMARY KEY (trip_id);' % stagingTn)
+    return stagingTn
+
+class stagingDb():
+    def __init__(self, db, stagingTn):
+        """Wraps a pgMapMatch dbConnection for the mapmatcher, so that the UPDATEs that writeMatchToPostgres() sends to the staging table
+        are held in memory, and sent by flushMatches() in the same statement as the UPDATE of the trace table, rather than one round trip per trace
+        The matched geometries are built in SQL by pgMapMatch, so these statements (rather than values) are what is held
+        Any other query or use of the connection sends the held statements first, so that the mapmatcher always reads its own writes"""
+        self.db, self.stagingTn, self.pending = db, stagingTn, []
+
+    def execute(self, cmd):
+        if cmd.lstrip().startswith('UPDATE %s ' % self.stagingTn):
+            self.pending.append(cmd.strip().rstrip(';')+';')
+        else:
+            self.flush()
+            self.db.execute(cmd)
+
+    def execfetch(self, *args, **kwargs):
+        self.flush()
+        return self.db.execfetch(*args, **kwargs)
+
+    def execfetchDf(self, *args, **kwargs):
+        self.flush()
+        return self.db.execfetchDf(*args, **kwargs)
+
+    def takePending(self):
+        """Returns the held statements as one string, and forgets them"""
+        cmd, self.pending = ''.join(self.pending), []
+        return cmd
+
+    def flush(self):
+        if len(self.pending)>0:
+            self.db.execute(self.takePending())
+
+    def __getattr__(self, name):  # anything else (e.g. the psycopg2 connection) goes straight to the wrapped connection
+        if name in ['db', 'stagingTn', 'pending']:  # not set yet, e.g. when unpickling
+            raise AttributeError(name)
+        self.flush()
+        return getattr(self.db, name)
+
+def flushMatches(db, stagingTn, traceTn, ids, doneIds, resolved=[], stagingSql=''):
+    """Copy the map matching results for ids from the staging table to the trace table, in a single UPDATE
+    doneIds (which includes traces that could not be matched) are recorded as completed in the same transaction,
+    as are the retried traces in resolved (see resolvedSql()), so a trace is never marked as resolved before its match is written
+    stagingSql: the held writes of the mapmatcher to the staging table (see stagingDb), which are sent first in the same statement"""
+    cmd = progressSql(traceTn, 'mapmatch', doneIds) + resolvedSql(traceTn, resolved)
+    if len(ids)>0:
+        cmd = '''UPDATE %s t SET %s FROM %s s
+                  WHERE t.trip_id=s.trip_id AND s.trip_id IN (%s);''' % (
+                  traceTn, ', '.join(['%s=s.%s' % (cc, cc) for cc in matchedCols]), stagingTn, ','.join([str(id) for id in ids])) + cmd
+    cmd = stagingSql + cmd
+    if cmd!='':
+        db.execute(cmd)
+
+def mapMatch_wrapper(pingDict, streetsTn, traceTn, schema='public', timeout=None, retry=False, flushsize=250):
+    """Wrapper for mapmatcher that avoids the problem with pickling objects in parallel
+    timeout: time limit for each trace, in seconds. Defaults to mapmatch_timeout
+    retry: True if these are quarantined or failed traces that are being retried (see traceTable.retryQuarantinedTraces() and retryFailedTraces())
+    flushsize: the matches are written to a staging table, and copied to the trace table every flushsize traces"""
+    if timeout is None:
+        timeout = mapmatch_timeout
     pgLogin = mmt.getPgLogin(user=pgInfo['user'], db=pgInfo['db'], host=pgInfo['host'], requirePassword=pgInfo['requirePassword'], forceUpdate=False)
     pgLogin['schema'] = schema
 
     #print('Entering mapMatch wrapper')
-    db = mmt.dbConnection(pgLogin=pgLogin, verbose=False) #, timeout=mapmatch_timeout, verbose=False)
+    db = mmt.dbConnection(pgLogin=pgLogin, verbose=False)
+    setStatementTimeout(db, timeout)
     #print('db connection')
-    mapMatcher = mm.mapMatcher(streetsTn, traceTn, 'trip_id', 'lbuff_geom', db=db, verbose=False, cleanedGeomName='lbuff_geom_cleaned',qualityModelFn=coeffFn)
+    stagingTn = createMatchStaging(db, traceTn, list(pingDict.keys()))
+    matchDb = stagingDb(db, stagingTn)
+    mapMatcher = mm.mapMatcher(streetsTn, stagingTn, 'trip_id', 'lbuff_geom', db=matchDb, verbose=False, cleanedGeomName='lbuff_geom_cleaned',qualityModelFn=coeffFn)
     #print('mapMatcher part')
     assert isinstance(pingDict, OrderedDict)
     #print('assert isinstance')
 
     starttime=time.time()
+    timing = []  # (trip_id, npings, seconds), so that later runs can balance the chunks (see traceTable.getMapMatchCosts())
+    matched = []  # trips that have been written to the staging table, but not yet to the trace table
+    done = []     # trips that have been processed (whether or not they matched), but not yet recorded as completed
+    resolved = [] # retried trips that have been processed, but not yet recorded as resolved
     for ii,id in enumerate(pingDict):
         if pingDict[id]>=3:
             try:
-                mapMatcher.matchPostgresTrace(id)
+                tracestart = time.time()
+                matchTraceWithTimeout(mapMatcher, id, timeout)
+                timing.append((id, pingDict[id], time.time()-tracestart))
                 #print('match postgres trace', id)
                 if mapMatcher.matchStatus==0:
                     mapMatcher.writeMatchToPostgres()
+                    matched.append(id)
                     #print('write match to postgres', id)
+                done.append(id)
+                if retry:
+                    resolved.append((id, time.time()-tracestart))
+                if len(done)>=flushsize:
+                    flushMatches(db, stagingTn, traceTn, matched, done, resolved, matchDb.takePending())
+                    matched, done, resolved = [], [], []
             except Exception as e:
-                print('***FAILED ON trace %s (#%d of %d)***' % (id,ii,len(pingDict)))
-                print(str(e))
+                if isTimeout(e):
+                    print('***TIMED OUT ON trace %s (#%d of %d) after %d seconds***' % (id,ii,len(pingDict),time.time()-tracestart))
+                    quarantineTrace(db, traceTn, id, pingDict[id], time.time()-tracestart, timeout)
+                else:
+                    print('***FAILED ON trace %s (#%d of %d)***' % (id,ii,len(pingDict)))
+                    print(str(e))
+                    recordFailure(db, traceTn, [(id, pingDict[id])], str(e), time.time()-tracestart)
+    flushMatches(db, stagingTn, traceTn, matched, done, resolved, matchDb.takePending())
+    db.execute('DROP TABLE %s;' % stagingTn)
     print('Finishing mapmatching chunk (through trace %d) in %d seconds' % (id, time.time()-starttime))
+    if len(timing)>0:
+        try:
+            db.execute('''INSERT INTO %s_mmtiming (trip_id, npings, seconds) VALUES %s
+                          ON CONFLICT (trip_id) DO UPDATE SET npings=EXCLUDED.npings, seconds=EXCLUDED.seconds;''' % (
+                            traceTn, ', '.join(['(%d, %d, %.3f)' % tt for tt in timing])))
+        except Exception as e:
+            print('Could not save mapmatching times: %s' % e)
+
+    return 0
 
+def executeSql_wrapper(cmd, pgLogin):
+    """Run cmd on the persistent connection of this worker (see getWorkerDb()), e.g. for one batch of trips in traceTable.writeStageResults()"""
+    getWorkerDb(pgLogin).execute(cmd)
+    return 0
+
+def lotPolygons_wrapper(tile, lotTn, streetsTn, offstreetTn, srs, pgLogin, maxVertices=256):
+    """Lot polygons for one tile (see traceTable.createLotPolygons()), inserted into lotTn
+    tile: (xmin, ymin, xmax, ymax). Only the streets and lots near the tile are buffered and unioned, and the result is clipped to the tile
+    The polygons are split into pieces of at most maxVertices vertices"""
+    db = getWorkerDb(pgLogin)
+    tileSql = 'ST_MakeEnvelope(%s, %s, %s, %s, %s)' % (tuple(tile)+(srs,))
+    offstSql = '' if offstreetTn is None else '''SELECT ST_Buffer(geom, 10) AS uniongeom FROM %s WHERE ST_DWithin(geom, %s, 10)
+                                                 UNION ALL''' % (offstreetTn, tileSql)
+    cmd = '''INSERT INTO %(lotTn)s (lotgeom)
+             SELECT ST_Subdivide(lotgeom, %(maxVertices)s) FROM
+                (SELECT ST_CollectionExtract(ST_Intersection(ST_Difference(lotgeom_big, COALESCE(streetbuffer, ST_GeomFromText('POLYGON EMPTY', %(srs)s))),
+                                                             %(tile)s), 3) AS lotgeom FROM
+                    (SELECT ST_Union(uniongeom) AS lotgeom_big FROM
+                        (%(offstSql)s
+                         SELECT ST_Buffer(geom_way, 10) AS uniongeom FROM %(sts)s WHERE clazz=51 AND ST_DWithin(geom_way, %(tile)s, 10)) t1) t2,
+                    (SELECT ST_Buffer(ST_Collect(geom_way), 5) AS streetbuffer FROM %(sts)s WHERE clazz!=51 AND ST_DWithin(geom_way, %(tile)s, 5)) t3) t4
+             WHERE NOT ST_IsEmpty(lotgeom);''' % {'lotTn': lotTn, 'maxVertices': maxVertices, 'srs': srs, 'tile': tileSql, 'offstSql': offstSql, 'sts': streetsTn}
+    db.execute(cmd)
     return 0
 
+def networkDistance_wrapper(trips, streetsTn, restrictionsTn, schema='public', maxCost=1e5):
+    """Wrapper for the in-process routing engine that avoids the problem with pickling objects in parallel
+    trips is a list of (trip_id, edge_id_start, stfr, edge_id_end, endfr) tuples
+    maxCost: see cruising_routing.streetRouter
+    Returns a list of (trip_id, netwkdist) tuples"""
+    pgLogin = mmt.getPgLogin(user=pgInfo['user'], db=pgInfo['db'], host=pgInfo['host'], requirePassword=pgInfo['requirePassword'], forceUpdate=False)
+    pgLogin['schema'] = schema
+    router = cr.getRouter(streetsTn, restrictionsTn, pgLogin, maxCost)
+
+    # group the trips by start edge, and do one one-to-many search per group
+    groups = defaultdict(list)
+    for id, edgeStart, stfr, edgeEnd, endfr in trips:
+        groups[edgeStart].append((id, stfr, edgeEnd, endfr))
+
+    starttime=time.time()
+    results = []
+    for edgeStart, group in groups.items():
+        dists = router.routeFromEdge(edgeStart, [gg[1:] for gg in group])
+        results += [(gg[0], dist) for gg, dist in zip(group, dists)]
+    if len(trips)>0:
+        print('Finishing routing chunk of %d trips (through trace %d) in %d seconds' % (len(trips), trips[-1][0], time.time()-starttime))
+    return results
+
 if __name__ == '__main__':
     """
     How to call from the command line
@@ -0,0 +1,227 @@
+"""
+In-process routing engine for the network distances in cruising.py
+This is an alternative to calling pgr_trsp once per trip, which re-reads the whole streets
+and turn restrictions tables every time
+
+The street graph and turn restrictions are loaded once (per worker process) into numpy arrays,
+and turn-restricted shortest paths between fractional positions on the start and end edges are found in python
+Distances are calculated in the same way as traceTable.calcNetworkDistance(), i.e. the route minimizes cost,
+and the length of each (partial) edge is weighted by the ratio of the cost used to the cost of the edge
+"""
+
+import heapq, time
+import numpy as np
+import pandas as pd
+import pgMapMatch.tools as mmt
+
+routerCache = {}  # one router per streets table, so that each worker process only loads the graph once
+
+class streetRouter():
+    def __init__(self, ids, sources, targets, costs, reverseCosts, lengths, restrictions=None, maxCost=1e5):
+        """
+        ids, sources, targets, costs, reverseCosts, lengths: arrays with one entry per edge of the streets table
+        restrictions: list of (from edge id, to edge id) turns that are not allowed
+        maxCost: give up when the cost of the route exceeds this. The default means that routes that pgRouting
+                 would only find by going the wrong way on a one-way street, or by making a restricted turn, are Null
+
+        Each edge can be traversed in two directions, so we route over 'states'
+        State 2*i is edge i from source to target, state 2*i+1 is edge i from target to source
+        """
+        self.ids = np.asarray(ids, dtype='int64')
+        self.nEdges = len(self.ids)
+        self.maxCost = maxCost
+        self.edgeLookup = dict(zip(self.ids.tolist(), range(self.nEdges)))
+
+        costs, reverseCosts, lengths = [np.asarray(aa, dtype='float64') for aa in [costs, reverseCosts, lengths]]
+        self.costs, self.reverseCosts, self.lengths = costs.tolist(), reverseCosts.tolist(), lengths.tolist()
+
+        # renumber the nodes so that they can be used as array indices
+        nodes, nodeIdx = np.unique(np.concatenate([np.asarray(sources), np.asarray(targets)]), return_inverse=True)
+        sourceIdx, targetIdx = nodeIdx[:self.nEdges], nodeIdx[self.nEdges:]
+
+        # cost, distance and start and end node of traversing each state in full
+        stateCost = np.empty(self.nEdges*2)
+        stateCost[0::2], stateCost[1::2] = costs, reverseCosts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stateDist = stateCost / np.repeat(costs, 2) * np.repeat(lengths, 2)
+        stateStart, stateEnd = np.empty(self.nEdges*2, dtype='int64'), np.empty(self.nEdges*2, dtype='int64')
+        stateStart[0::2], stateStart[1::2] = sourceIdx, targetIdx
+        stateEnd[0::2], stateEnd[1::2] = targetIdx, sourceIdx
+        self.stateCost, self.stateDist, self.stateEnd = stateCost.tolist(), stateDist.tolist(), stateEnd.tolist()
+
+        # compressed sparse row representation of the states that leave each node
+        order = np.argsort(stateStart, kind='stable')
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(stateStart, minlength=len(nodes)))]).tolist()
+        self.outStates = order.tolist()
+
+        # turn restrictions, stored as from_edge_index*nEdges + to_edge_index
+        self.restrictions = set()
+        for fromId, toId in (restrictions if restrictions is not None else []):
+            if int(fromId) in self.edgeLookup and int(toId) in self.edgeLookup:
+                self.restrictions.add(self.edgeLookup[int(fromId)]*self.nEdges + self.edgeLookup[int(toId)])
+
+    def partialDist(self, edge, cost):
+        """Distance along edge when cost is used, i.e. the cost ratio times the edge length"""
+        return np.nan if self.costs[edge]==0 else cost/self.costs[edge]*self.lengths[edge]
+
+    def search(self, initial, targets):
+        """Dijkstra search over the states, from one or more initial (cost, distance, state) labels
+        targets: list of (edge index, fractional position) pairs. The search stops when all of them have been reached
+        Returns a list with the (cost, distance) of the best route to each target, or (np.inf, np.nan) if there is none"""
+        costs, reverseCosts = self.costs, self.reverseCosts
+        stateCost, stateDist, stateEnd = self.stateCost, self.stateDist, self.stateEnd
+        indptr, outStates, restrictions, nEdges = self.indptr, self.outStates, self.restrictions, self.nEdges
+
+        targetsByEdge = {}
+        for ii, (edge, fr) in enumerate(targets):
+            targetsByEdge.setdefault(edge, []).append((ii, fr))
+        results = [(np.inf, np.nan)]*len(targets)
+        nRemaining = len(targets)
+
+        # heap entries are (cost, distance, state). A negative state of -1-ii means that target ii has been reached
+        heap = list(initial)
+        heapq.heapify(heap)
+        settled = set()
+        while heap and nRemaining>0:
+            cost, dist, state = heapq.heappop(heap)
+            if cost>self.maxCost:
+                break
+            if state<0:
+                if np.isinf(results[-1-state][0]):
+                    results[-1-state] = (cost, dist)
+                    nRemaining -= 1
+                continue
+            if state in settled:
+                continue
+            settled.add(state)
+            edge, node = state >> 1, stateEnd[state]
+            for nextState in outStates[indptr[node]:indptr[node+1]]:
+                nextEdge = nextState >> 1
+                if edge*nEdges+nextEdge in restrictions:
+                    continue
+                for ii, fr in targetsByEdge.get(nextEdge, []):  # partial traversal of the end edge
+                    endCost = costs[nextEdge]*fr if nextState & 1==0 else reverseCosts[nextEdge]*(1-fr)
+                    heapq.heappush(heap, (cost+endCost, dist+self.partialDist(nextEdge, endCost), -1-ii))
+                if nextState not in settled:
+                    heapq.heappush(heap, (cost+stateCost[nextState], dist+stateDist[nextState], nextState))
+        return results
+
+    def sameEdgeRoutes(self, s, frStart, frEnd):
+        """Routes that stay on the start edge, when the start and end edge are the same"""
+        routes = []
+        if frEnd>=frStart:
+            routes.append((self.costs[s]*(frEnd-frStart), self.partialDist(s, self.costs[s]*(frEnd-frStart))))
+        if frEnd<=frStart:
+            routes.append((self.reverseCosts[s]*(frStart-frEnd), self.partialDist(s, self.reverseCosts[s]*(frStart-frEnd))))
+        return routes
+
+    def bestDistance(self, routes):
+        """Distance of the lowest-cost of a list of (cost, distance) routes"""
+        cost, dist = min(routes, key=lambda x: x[0])
+        return np.nan if cost>self.maxCost else dist
+
+    def route(self, edgeStart, frStart, edgeEnd, frEnd):
+        """Returns the network distance from position frStart (0-1) on edge edgeStart
+        to position frEnd on edge edgeEnd, or np.nan if no route is found"""
+        try:
+            s, e = self.edgeLookup[int(edgeStart)], self.edgeLookup[int(edgeEnd)]
+        except (KeyError, TypeError, ValueError):
+            return np.nan
+        if any([np.isnan(ff) for ff in [frStart, frEnd]]):
+            return np.nan
+        initial = [(self.costs[s]*(1-frStart), self.partialDist(s, self.costs[s]*(1-frStart)), 2*s),
+                   (self.reverseCosts[s]*frStart, self.partialDist(s, self.reverseCosts[s]*frStart), 2*s+1)]
+        routes = self.search(initial, [(e, frEnd)])
+        if s==e:
+            routes += self.sameEdgeRoutes(s, frStart, frEnd)
+        return self.bestDistance(routes)
+
+    def routeFromEdge(self, edgeStart, trips):
+        """One-to-many version of route(), for a group of trips that start on the same edge
+        trips: list of (frStart, edgeEnd, frEnd) tuples
+        Rather than one search per trip, we do one search from each end of the start edge to all the end edges,
+        and then add the fractional part of the start edge for each trip. Returns a list of distances"""
+        try:
+            s = self.edgeLookup[int(edgeStart)]
+        except (KeyError, TypeError, ValueError):
+            return [np.nan]*len(trips)
+        if len(trips)==1:
+            return [self.route(edgeStart, *trips[0])]
+
+        valid, targets = [], []
+        for frStart, edgeEnd, frEnd in trips:
+            try:
+                e = self.edgeLookup[int(edgeEnd)]
+                isValid = not np.isnan(frStart) and not np.isnan(frEnd)
+            except (KeyError, TypeError, ValueError):
+                e, isValid = -1, False
+            valid.append(isValid)
+            targets.append((e, frEnd))
+        searchTargets = [tt for tt, vv in zip(targets, valid) if vv]
+        forward = iter(self.search([(0, 0, 2*s)], searchTargets))    # leaving the start edge at its target node
+        backward = iter(self.search([(0, 0, 2*s+1)], searchTargets)) # leaving the start edge at its source node
+
+        dists = []
+        for (frStart, edgeEnd, frEnd), (e, _), isValid in zip(trips, targets, valid):
+            if not isValid:
+                dists.append(np.nan)
+                continue
+            (fCost, fDist), (bCost, bDist) = next(forward), next(backward)
+            startCost, startRevCost = self.costs[s]*(1-frStart), self.reverseCosts[s]*frStart
+            routes = [(startCost+fCost, self.partialDist(s, startCost)+fDist), (startRevCost+bCost, self.partialDist(s, startRevCost)+bDist)]
+            if s==e:
+                routes += self.sameEdgeRoutes(s, frStart, frEnd)
+            dists.append(self.bestDistance(routes))
+        return dists
+
+def loadRouter(db, streetsTn, restrictionsTn=None, maxCost=1e5):
+    """Load the streets table and turn restrictions table into a streetRouter"""
+    edges = db.execfetch('SELECT id, source, target, cost, reverse_cost, ST_Length(geom_way) FROM %s;' % streetsTn)
+    ids, sources, targets, costs, reverseCosts, lengths = zip(*edges)
+    if restrictionsTn is not None:
+        restrictions = db.execfetch('SELECT source_id::bigint, target_id::bigint FROM %s;' % restrictionsTn)
+    else:
+        restrictions = []
+    return streetRouter(ids, sources, targets, costs, reverseCosts, lengths, restrictions, maxCost=maxCost)
+
+def getRouter(streetsTn, restrictionsTn, pgLogin, maxCost=1e5):
+    """Returns the streetRouter for this streets table (and maxCost), loading it if this process hasn't done so already"""
+    key = (pgLogin.get('schema'), streetsTn, restrictionsTn, maxCost)
+    if key not in routerCache:
+        db = mmt.dbConnection(pgLogin=pgLogin, verbose=False)
+        routerCache[key] = loadRouter(db, streetsTn, restrictionsTn, maxCost=maxCost)
+    return routerCache[key]
+
+def pgRoutingDistance(db, streetsTn, restrictionsTn, edgeStart, frStart, edgeEnd, frEnd):
+    """Network distance from pgr_trsp, calculated in the same way as traceTable.calcNetworkDistance()
+    Returns np.nan if no path is found, or if the path is implausible (>1e6), as netwkdist is then Null"""
+    cmd = '''SELECT SUM(pgr.cost/r.cost*ST_Length(r.geom_way))
+                FROM pgr_trsp('SELECT id::int4, source::int4, target::int4, cost::float8, reverse_cost::float8 FROM %s',
+                              %d, %s, %d, %s, True, True,
+                              'SELECT to_cost::float8, target_id::int4, source_id::text AS via_path FROM %s') AS pgr,
+                     %s AS r WHERE pgr.id2=r.id;''' % (streetsTn, edgeStart, frStart, edgeEnd, frEnd, restrictionsTn, streetsTn)
+    try:
+        dist = db.execfetch(cmd)[0][0]
+    except Exception:  # path not found
+        if hasattr(db, 'connection'):
+            db.connection.rollback()
+        return np.nan
+    return np.nan if dist is None or dist>1e6 else dist
+
+def compareWithPgRouting(db, router, trips, streetsTn, restrictionsTn, tolerance=1):
+    """Route each trip with both router and pgr_trsp (see pgRoutingDistance()), to check that they agree and compare their speed
+    trips: list of (trip_id, edge_id_start, stfr, edge_id_end, endfr) tuples
+    tolerance: distances (meters) that differ by no more than this agree. Trips with no route from either also agree
+    Returns a dataframe indexed by trip_id, with the distance and seconds from each, the difference, and whether they agree"""
+    rows = []
+    for id, edgeStart, stfr, edgeEnd, endfr in trips:
+        starttime = time.time()
+        pgrDist = pgRoutingDistance(db, streetsTn, restrictionsTn, edgeStart, stfr, edgeEnd, endfr)
+        pgrSecs = time.time()-starttime
+        starttime = time.time()
+        dist = router.route(edgeStart, stfr, edgeEnd, endfr)
+        rows.append([id, pgrDist, dist, pgrSecs, time.time()-starttime])
+    result = pd.DataFrame(rows, columns=['trip_id', 'pgr_dist', 'inprocess_dist', 'pgr_secs', 'inprocess_secs']).set_index('trip_id')
+    result['diff'] = result.inprocess_dist-result.pgr_dist
+    result['agree'] = (result['diff'].abs()<=tolerance) | (result.pgr_dist.isnull() & result.inprocess_dist.isnull())
+    return result